@@ -9,6 +9,12 @@ from trytond.pool import Pool
 from carrier import Carrier
 from sale import Sale
 from shipment import ShipmentOut
+from price_list import PriceList, PriceListLine
+from product import Template, Product
+from rate import CarrierPricelistRate
+from tier import CarrierTier
+from zone import CarrierZone, CarrierZoneCountry, CarrierZoneSubdivision, \
+    CarrierZoneZip
 
 
 def register():
@@ -16,5 +22,15 @@ def register():
         Sale,
         ShipmentOut,
         Carrier,
+        PriceList,
+        PriceListLine,
+        Template,
+        Product,
+        CarrierPricelistRate,
+        CarrierTier,
+        CarrierZone,
+        CarrierZoneCountry,
+        CarrierZoneSubdivision,
+        CarrierZoneZip,
         module='carrier_pricelist', type_='model'
     )
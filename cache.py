@@ -0,0 +1,98 @@
+# -*- coding: utf-8 -*-
+"""
+    cache.py
+
+    :copyright: (c) 2014 by Openlabs Technologies & Consulting (P) Limited
+    :license: BSD, see LICENSE for more details.
+"""
+import time
+from threading import Lock
+
+from trytond.transaction import Transaction
+from trytond.cache import Cache, LRUDict
+
+from stats import cache_hit
+
+__all__ = ['TransactionCache', 'SharedCache']
+
+
+class TransactionCache(object):
+    """
+    A key value LRU cache with size limit which lives as long as the
+    current transaction.
+
+    The values are stored in the cache of the cursor, which is cleared on
+    commit and rollback. The hits and misses are counted for the process.
+    """
+
+    def __init__(self, name, size_limit=1024):
+        self.size_limit = size_limit
+        self._name = name
+        self.hits = 0
+        self.misses = 0
+        self._lock = Lock()
+
+    def _get_cache(self):
+        cache = Transaction().cursor.cache
+        key = ('carrier_pricelist', self._name)
+        if key not in cache:
+            cache[key] = LRUDict(self.size_limit)
+        return cache[key]
+
+    def get(self, key, default=None):
+        cache = self._get_cache()
+        try:
+            result = cache[key] = cache.pop(key)
+        except KeyError:
+            with self._lock:
+                self.misses += 1
+            cache_hit(False)
+            return default
+        with self._lock:
+            self.hits += 1
+        cache_hit(True)
+        return result
+
+    def set(self, key, value):
+        self._get_cache()[key] = value
+        return value
+
+    def clear(self):
+        self._get_cache().clear()
+
+    def stats(self):
+        "Returns a dictionary with the hits and misses of the cache"
+        with self._lock:
+            return {
+                'name': self._name,
+                'hits': self.hits,
+                'misses': self.misses,
+            }
+
+    def reset_stats(self):
+        with self._lock:
+            self.hits = self.misses = 0
+
+
+class SharedCache(Cache):
+    """
+    A trytond cache, shared by the transactions of the process for each
+    database, whose values may expire after a duration.
+    """
+
+    def get(self, key, default=None, duration=None):
+        """Return the value for the key unless it is older than the duration
+
+        :param duration: The number of seconds a value is valid
+        """
+        result = super(SharedCache, self).get(key)
+        if result is None:
+            return default
+        timestamp, value = result
+        if duration and time.time() - timestamp > float(duration):
+            return default
+        return value
+
+    def set(self, key, value):
+        super(SharedCache, self).set(key, (time.time(), value))
+        return value
@@ -5,17 +5,47 @@
     :copyright: (c) 2014 by Openlabs Technologies & Consulting (P) Limited
     :license: BSD, see LICENSE for more details.
 """
-from decimal import Decimal
+from decimal import Decimal, ROUND_HALF_EVEN
+from collections import defaultdict
+from bisect import bisect_left
+from multiprocessing.pool import ThreadPool
 
 from trytond.transaction import Transaction
+from trytond.config import CONFIG
 from trytond.exceptions import UserError
 from trytond.pool import PoolMeta, Pool
 from trytond.model import fields
-from trytond.pyson import Eval
+from trytond.pyson import Eval, Id
+from trytond.rpc import RPC
+
+from cache import TransactionCache, SharedCache
+from stats import counters, registry, instrument, measure, note
+from zone import normalize_zip
+import vectorize
 
 __metaclass__ = PoolMeta
 __all__ = ['Carrier']
 
+PRICES_CACHE_SIZE = 10240
+UOMS_CACHE_SIZE = 10240
+RATES_CACHE_SIZE = 1024
+TIERS_CACHE_SIZE = 64
+TIER_MEASURES_CACHE_SIZE = 10240
+
+# The costs shared across requests are only cached when enabled in the
+# [options] section of the trytond configuration file:
+#   carrier_pricelist_cache = True
+#   carrier_pricelist_cache_size = 1024
+#   carrier_pricelist_cache_ttl = 3600
+COSTS_CACHE_SIZE = int(CONFIG.get('carrier_pricelist_cache_size', 1024))
+ESTIMATES_CACHE_SIZE = 1024
+ZONES_CACHE_SIZE = 256
+
+
+def _is_id(value):
+    "Returns True if the value can be the id of a record"
+    return isinstance(value, (int, long)) and not isinstance(value, bool)
+
 
 class Carrier:
     __name__ = "carrier"
@@ -26,6 +56,75 @@ class Carrier:
             "invisible": Eval("carrier_cost_method") != "pricelist"
         }
     )
+    pricelist_kind = fields.Selection([
+        (None, ''),
+        ('constant', 'Constant per Unit'),
+        ('product', 'Per Product'),
+        ('general', 'General'),
+    ], 'Price List Kind', readonly=True, states={
+        "invisible": Eval("carrier_cost_method") != "pricelist"
+    }, depends=['carrier_cost_method'])
+    pricelist_rate = fields.Numeric(
+        'Price List Rate', readonly=True, states={
+            "invisible": Eval("pricelist_kind") != "constant"
+        }, depends=['pricelist_kind']
+    )
+
+    tiers = fields.One2Many(
+        'carrier.tier', 'carrier', 'Tiers', states={
+            "invisible": Eval("carrier_cost_method") != "tier"
+        }, depends=['carrier_cost_method']
+    )
+    tier_weight_uom = fields.Many2One(
+        'product.uom', 'Tier Weight UOM', domain=[
+            ('category', '=', Id('product', 'uom_cat_weight')),
+        ], states={
+            "required": Eval("carrier_cost_method") == "tier",
+            "invisible": Eval("carrier_cost_method") != "tier"
+        }, depends=['carrier_cost_method']
+    )
+    tier_volume_uom = fields.Many2One(
+        'product.uom', 'Tier Volume UOM', domain=[
+            ('category', '=', Id('product', 'uom_cat_volume')),
+        ], states={
+            "invisible": Eval("carrier_cost_method") != "tier"
+        }, depends=['carrier_cost_method']
+    )
+
+    zones = fields.One2Many(
+        'carrier.zone', 'carrier', 'Zones', states={
+            "invisible": Eval("carrier_cost_method") != "pricelist"
+        }, depends=['carrier_cost_method']
+    )
+
+    _pricelist_carriers_cache = TransactionCache(
+        'carrier.pricelist_carriers', size_limit=16
+    )
+    _pricelist_prices_cache = TransactionCache(
+        'carrier.pricelist_prices', size_limit=PRICES_CACHE_SIZE
+    )
+    _pricelist_uoms_cache = TransactionCache(
+        'carrier.pricelist_uoms', size_limit=UOMS_CACHE_SIZE
+    )
+    _pricelist_rates_cache = TransactionCache(
+        'carrier.pricelist_rates', size_limit=RATES_CACHE_SIZE
+    )
+    _pricelist_costs_cache = SharedCache(
+        'carrier.pricelist_costs', size_limit=COSTS_CACHE_SIZE, context=False
+    )
+    _pricelist_estimates_cache = SharedCache(
+        'carrier.pricelist_estimates', size_limit=ESTIMATES_CACHE_SIZE,
+        context=False
+    )
+    _tiers_cache = TransactionCache(
+        'carrier.tiers', size_limit=TIERS_CACHE_SIZE
+    )
+    _tier_measures_cache = TransactionCache(
+        'carrier.tier_measures', size_limit=TIER_MEASURES_CACHE_SIZE
+    )
+    _zones_cache = SharedCache(
+        'carrier.zones', size_limit=ZONES_CACHE_SIZE, context=False
+    )
 
     @classmethod
     def __setup__(cls):
@@ -33,7 +132,1196 @@ class Carrier:
         selection = ('pricelist', 'Price List')
         if selection not in cls.carrier_cost_method.selection:
             cls.carrier_cost_method.selection.append(selection)
+        selection = ('tier', 'Weight and Volume Tiers')
+        if selection not in cls.carrier_cost_method.selection:
+            cls.carrier_cost_method.selection.append(selection)
+        cls.__rpc__.update({
+            'get_pricelist_stats': RPC(),
+            'reset_pricelist_stats': RPC(readonly=False),
+            'quote_pricelist_rates': RPC(),
+            'quote_pricelist_rates_batch': RPC(),
+        })
+
+    @classmethod
+    def create(cls, vlist):
+        cls._pricelist_carriers_cache.clear()
+        # The id of a deleted carrier may be reused
+        cls._zones_cache.clear()
+        cls.clear_pricelist_caches()
+        carriers = super(Carrier, cls).create(vlist)
+        cls.update_pricelist_kinds(carriers)
+        return carriers
+
+    @classmethod
+    def write(cls, *args):
+        cls._pricelist_carriers_cache.clear()
+        cls._zones_cache.clear()
+        cls.clear_pricelist_caches()
+        super(Carrier, cls).write(*args)
+
+        actions = iter(args)
+        to_update = []
+        for carriers, values in zip(actions, actions):
+            if 'price_list' in values or 'carrier_cost_method' in values:
+                to_update.extend(carriers)
+        cls.update_pricelist_kinds(to_update)
+
+    @classmethod
+    def delete(cls, carriers):
+        cls._pricelist_carriers_cache.clear()
+        # The index of a deleted carrier must not be found by a new one
+        cls._zones_cache.clear()
+        cls.clear_pricelist_caches()
+        return super(Carrier, cls).delete(carriers)
+
+    @classmethod
+    def clear_pricelist_caches(cls):
+        """Clear the cached prices and costs
+
+        The costs shared across requests are cleared through the trytond
+        cache mechanism, so that the other processes clear them too.
+        """
+        cls._pricelist_prices_cache.clear()
+        cls._pricelist_uoms_cache.clear()
+        cls._pricelist_rates_cache.clear()
+        cls._pricelist_estimates_cache.clear()
+        cls._tier_measures_cache.clear()
+        if cls._pricelist_costs_cache_enabled():
+            cls._pricelist_costs_cache.clear()
+
+    @classmethod
+    def update_pricelist_kinds(cls, carriers, products=None):
+        """Classify the price list of the carriers and store the kind, see
+        :meth:`get_pricelist_kind`, then refresh their materialized rates
+
+        :param products: The products whose rates may have changed, defaults
+            to all the products. All the rates of the carriers whose kind
+            changes are refreshed.
+        """
+        Rate = Pool().get('carrier.pricelist.rate')
+
+        to_write, changed = [], []
+        for carrier in cls.browse(carriers):
+            kind, rate = None, None
+            if carrier.carrier_cost_method == 'pricelist' \
+                    and carrier.price_list:
+                kind, rate = carrier.get_pricelist_kind()
+            if (carrier.pricelist_kind, carrier.pricelist_rate) != (kind, rate):
+                to_write.extend(([carrier], {
+                    'pricelist_kind': kind,
+                    'pricelist_rate': rate,
+                }))
+                changed.append(carrier.id)
+        if to_write:
+            # Do not clear the caches again
+            super(Carrier, cls).write(*to_write)
+        Rate.refresh(cls.browse(changed))
+        Rate.refresh(cls.browse([
+            c for c in map(int, carriers) if c not in changed
+        ]), products)
+
+    def get_pricelist_kind(self):
+        """Classify the price list of the carrier from the lines matching
+        the products priced with a null quantity
+
+        The kind is 'constant' when all the products get the same unit
+        price, 'product' when the unit price depends only on the product and
+        'general' otherwise.
+
+        :returns: A tuple of (kind, rate) where rate is the unit price of the
+            constant price lists or else None
+        """
+        values = set()
+        constant = True
+        for line in self.price_list.lines:
+            if line.quantity is not None and line.quantity > 0:
+                continue
+            if not line.is_product_formula():
+                return 'general', None
+            value = line.get_constant_unit_price()
+            if value is None:
+                constant = False
+            else:
+                values.add(value)
+            if not line.product:
+                # The line matches all the remaining products
+                if constant and len(values) == 1:
+                    return 'constant', value
+                return 'product', None
+        # The products matching no line get their list price
+        return 'product', None
+
+    @staticmethod
+    def _pricelist_costs_cache_enabled():
+        return bool(CONFIG.get('carrier_pricelist_cache'))
+
+    @classmethod
+    def get_pricelist_stats(cls):
+        """Returns the measures of the pricelist computations of the process
+
+        The calls are only measured when carrier_pricelist_stats is enabled
+        in the trytond configuration.
+        """
+        return {
+            'calls': registry.get(),
+            'counters': counters.items(),
+            'caches': [
+                cls._pricelist_carriers_cache.stats(),
+                cls._pricelist_prices_cache.stats(),
+                cls._pricelist_uoms_cache.stats(),
+                cls._pricelist_rates_cache.stats(),
+                cls._tiers_cache.stats(),
+                cls._tier_measures_cache.stats(),
+            ],
+        }
+
+    @classmethod
+    def reset_pricelist_stats(cls):
+        """Clear the measures of the process, only allowed to the
+        administrators as the measures are shared by all the users
+        """
+        pool = Pool()
+        User = pool.get('res.user')
+        ModelData = pool.get('ir.model.data')
+
+        user = Transaction().user
+        if user and ModelData.get_id('res', 'group_admin') not in \
+                [g.id for g in User(user).groups]:
+            raise UserError(
+                "Only the administrators can reset the pricelist stats."
+            )
+
+        registry.reset()
+        counters.reset()
+        cls._pricelist_carriers_cache.reset_stats()
+        cls._pricelist_prices_cache.reset_stats()
+        cls._pricelist_uoms_cache.reset_stats()
+        cls._pricelist_rates_cache.reset_stats()
+        cls._tiers_cache.reset_stats()
+        cls._tier_measures_cache.reset_stats()
+
+    @classmethod
+    def get_pricelist_carriers(cls):
+        """Returns the carriers using the pricelist cost method
+
+        The lookup is cached for the transaction.
+        """
+        key = (Transaction().user, Transaction().context.get('company'))
+        carrier_ids = cls._pricelist_carriers_cache.get(key)
+        if carrier_ids is None:
+            with measure('carrier.search'):
+                carrier_ids = cls._pricelist_carriers_cache.set(key, map(
+                    int, cls.search([
+                        ('carrier_cost_method', '=', 'pricelist')
+                    ])
+                ))
+        return cls.browse(carrier_ids)
+
+    @classmethod
+    def get_pricelist_carrier(cls, carrier=None):
+        """Returns the carrier if it uses the pricelist cost method or else
+        the first carrier using it.
+        """
+        if carrier and carrier.carrier_cost_method == 'pricelist':
+            return carrier
+
+        carriers = cls.get_pricelist_carriers()
+        if not carriers:
+            raise UserError("No carrier with pricelist cost method found.")
+        return carriers[0]
+
+    def get_pricelist_prices(self, product_ids, customer, currency):
+        """Returns the unit shipping prices of the products from the price
+        list of the carrier
+
+        The prices are cached for the transaction by (price_list, customer,
+        currency, product, quantity, date). The products are not priced when
+        the price list is constant.
+
+        :param product_ids: A list of product.product ids
+        :param customer: The id of the customer party
+        :param currency: The id of the currency of the prices
+        :returns: A dictionary of product id: price
+        """
+        Product = Pool().get('product.product')
+        Date = Pool().get('ir.date')
+
+        if self.pricelist_kind == 'constant':
+            return dict.fromkeys(product_ids, self.pricelist_rate)
+
+        cache = self._pricelist_prices_cache
+        date = Transaction().context.get('sale_date') or Date.today()
+
+        def key(product_id):
+            return (self.price_list.id, customer, currency, product_id, 0, date)
+
+        prices, missing = {}, []
+        for product_id in product_ids:
+            price = cache.get(key(product_id))
+            if price is None:
+                missing.append(product_id)
+            else:
+                prices[product_id] = price
+
+        if missing:
+            with Transaction().set_context(
+                    customer=customer, price_list=self.price_list.id,
+                    currency=currency), \
+                    measure('product.get_sale_price'):
+                note('products', len(missing))
+                computed = Product.get_sale_price(Product.browse(missing))
+            for product_id in missing:
+                prices[product_id] = cache.set(
+                    key(product_id), computed[product_id]
+                )
+        return prices
+
+    @classmethod
+    def _get_pricelist_default_uoms(cls, product_ids):
+        """Returns the default unit of the products, in which the prices of
+        the price list are expressed
+
+        The units are cached for the transaction.
+
+        :returns: A dictionary of product id: uom id
+        """
+        Product = Pool().get('product.product')
+
+        cache = cls._pricelist_uoms_cache
+        uoms, missing = {}, []
+        for product_id in product_ids:
+            uom_id = cache.get(('product', product_id))
+            if uom_id is None:
+                missing.append(product_id)
+            else:
+                uoms[product_id] = uom_id
+        for product in Product.browse(missing):
+            uoms[product.id] = cache.set(
+                ('product', product.id), product.default_uom.id
+            )
+        return uoms
+
+    @classmethod
+    def _get_pricelist_uom_conversions(cls, pairs):
+        """Returns the conversion of the quantities between the units
+
+        The conversions are computed once per pair of units and cached for
+        the transaction.
+
+        :param pairs: An iterable of (from uom id, to uom id)
+        :returns: A dictionary of pair: a tuple (from value, from is factor,
+            to value, to is factor, rounding) or None when the quantities are
+            kept as is
+        """
+        Uom = Pool().get('product.uom')
+
+        cache = cls._pricelist_uoms_cache
+        conversions, missing = {}, []
+        for pair in pairs:
+            conversion = cache.get(('conversion', pair), default=False)
+            if conversion is False:
+                missing.append(pair)
+            else:
+                conversions[pair] = conversion
+        for from_id, to_id in missing:
+            from_uom, to_uom = Uom(from_id), Uom(to_id)
+            conversion = None
+            if from_id != to_id and from_uom.category == to_uom.category:
+                conversion = (
+                    from_uom.factor if from_uom.accurate_field == 'factor'
+                    else from_uom.rate,
+                    from_uom.accurate_field == 'factor',
+                    to_uom.factor if to_uom.accurate_field == 'factor'
+                    else to_uom.rate,
+                    to_uom.accurate_field == 'factor',
+                    to_uom.rounding,
+                )
+            conversions[(from_id, to_id)] = cache.set(
+                ('conversion', (from_id, to_id)), conversion
+            )
+        return conversions
+
+    @staticmethod
+    def _convert_pricelist_quantity(conversion, quantity):
+        """Convert the quantity like `product.uom.compute_qty`
+
+        :param conversion: A conversion of
+            :meth:`_get_pricelist_uom_conversions`
+        """
+        Uom = Pool().get('product.uom')
+
+        if conversion is None:
+            return quantity
+        from_value, from_factor, to_value, to_factor, rounding = conversion
+        if from_factor:
+            amount = quantity * from_value
+        else:
+            amount = quantity / from_value
+        if to_factor:
+            amount = amount / to_value
+        else:
+            amount = amount * to_value
+        return Uom.round(amount, rounding)
+
+    @classmethod
+    def group_pricelist_quantities(cls, rows):
+        """Group the lines of a document by product and quantity so that
+        each distinct product is priced only once
+
+        The quantities are converted to the default unit of the products
+        with the conversions of the distinct pairs of units.
+
+        :param rows: An iterable of tuple: (product id, quantity, unit id,
+            count)
+        :returns: A dictionary of (product id, quantity): count
+        """
+        rows = [row for row in rows]
+        uoms = cls._get_pricelist_default_uoms(
+            set(row[0] for row in rows if row[2] is not None)
+        )
+        conversions = cls._get_pricelist_uom_conversions(set(
+            (unit_id, uoms[product_id])
+            for product_id, _, unit_id, _ in rows if unit_id is not None
+        ))
+
+        quantities = defaultdict(int)
+        for product_id, quantity, unit_id, count in rows:
+            if unit_id is not None:
+                quantity = cls._convert_pricelist_quantity(
+                    conversions[(unit_id, uoms[product_id])], quantity
+                )
+            quantities[(product_id, quantity)] += count
+        return quantities
+
+    @classmethod
+    def _get_pricelist_currency_rates(cls, pairs):
+        """Returns the rates to convert amounts between the currencies at
+        the date of the context
+
+        The rates are read once per (from currency, to currency, date) and
+        cached for the transaction.
+
+        :param pairs: An iterable of (from currency id, to currency id)
+        :returns: A dictionary of pair: a tuple (from rate, to rate,
+            rounding of the to currency)
+        """
+        Currency = Pool().get('currency.currency')
+        Date = Pool().get('ir.date')
+
+        cache = cls._pricelist_rates_cache
+        date = Transaction().context.get('date', Date.today())
+        rates, missing = {}, []
+        for pair in pairs:
+            rate = cache.get(pair + (date,))
+            if rate is None:
+                missing.append(pair)
+            else:
+                rates[pair] = rate
+        if not missing:
+            return rates
+
+        currencies = dict((c.id, c) for c in Currency.browse(list(set(
+            currency_id for pair in missing for currency_id in pair
+        ))))
+        for from_id, to_id in missing:
+            from_currency, to_currency = currencies[from_id], currencies[to_id]
+            if from_id != to_id and \
+                    (not from_currency.rate or not to_currency.rate):
+                # Raise the error of the missing rate
+                Currency.compute(from_currency, Decimal('1'), to_currency)
+            rates[(from_id, to_id)] = cache.set((from_id, to_id, date), (
+                from_currency.rate, to_currency.rate, to_currency.rounding
+            ))
+        return rates
+
+    @classmethod
+    def convert_pricelist_costs(cls, costs):
+        """Convert many amounts between currencies like
+        `currency.currency.compute` does, reading each rate only once
+
+        :param costs: A list of tuple (amount, from currency id, to currency
+            id)
+        :returns: The list of the rounded converted amounts
+        """
+        rates = cls._get_pricelist_currency_rates(set(
+            (from_id, to_id) for _, from_id, to_id in costs
+        ))
+        result = []
+        for amount, from_id, to_id in costs:
+            from_rate, to_rate, rounding = rates[(from_id, to_id)]
+            if from_id != to_id:
+                amount = amount * to_rate / from_rate
+            result.append((amount / rounding).quantize(
+                Decimal('1.'), rounding=ROUND_HALF_EVEN
+            ) * rounding)
+        return result
+
+    @staticmethod
+    def _sum_pricelist_cost(prices, quantities):
+        """Return the total of the prices multiplied by the quantities
+
+        When enabled, the total is reduced with the vectorized engine and
+        falls back to the Decimal arithmetic when the engine can not compute
+        it exactly.
+
+        :param prices: A dictionary of product id: price
+        :param quantities: A dictionary of (product id, quantity): count
+        """
+        if vectorize.enabled():
+            total = vectorize.dot(prices, quantities)
+            if total is not None:
+                counters.incr('carrier.pricelist_cost.vectorized')
+                return total
+
+        total = Decimal('0')
+        for (product_id, quantity), count in quantities.iteritems():
+            total += prices[product_id] * Decimal(quantity) * count
+        return total
+
+    def get_pricelist_costs(self, quantities, customer, currency):
+        """Returns the pricelist shipping costs of many groups of products
+
+        The products of all the groups are priced with a single call, or not
+        at all when the price list is constant. When enabled, the costs are
+        also cached across requests.
+
+        :param quantities: A list of dictionary of (product id, quantity):
+            count
+        :param customer: The id of the customer party
+        :param currency: The id of the currency of the costs
+        :returns: A list of the costs in the order of the quantities
+        """
+        Date = Pool().get('ir.date')
+
+        cache = self._pricelist_costs_cache
+        shared = self._pricelist_costs_cache_enabled()
+        duration = CONFIG.get('carrier_pricelist_cache_ttl')
+        date = Transaction().context.get('sale_date') or Date.today()
+
+        def key(group):
+            return (
+                self.price_list.id, customer, currency,
+                Transaction().context.get('company'), date,
+                frozenset(group.iteritems()),
+            )
+
+        costs = [None] * len(quantities)
+        if shared:
+            for index, group in enumerate(quantities):
+                costs[index] = cache.get(key(group), duration=duration)
+
+        missing = [i for i, cost in enumerate(costs) if cost is None]
+        note('lines', sum(sum(quantities[i].itervalues()) for i in missing))
+        if missing and self.pricelist_kind == 'constant':
+            # The rate of the price list times the total quantity
+            counters.incr('carrier.pricelist_cost.constant', len(missing))
+            for index in missing:
+                costs[index] = self.pricelist_rate * sum(
+                    Decimal(quantity) * count
+                    for (_, quantity), count in quantities[index].iteritems()
+                )
+                if shared:
+                    cache.set(key(quantities[index]), costs[index])
+        elif missing:
+            product_ids = set(
+                product_id
+                for index in missing
+                for product_id, _ in quantities[index]
+            )
+            prices = self.get_pricelist_prices(product_ids, customer, currency)
+            for index in missing:
+                costs[index] = self._sum_pricelist_cost(
+                    prices, quantities[index]
+                )
+                if shared:
+                    cache.set(key(quantities[index]), costs[index])
+        return costs
+
+    def get_pricelist_cost(self, quantities, customer, currency):
+        """Returns the pricelist shipping cost of the products
+
+        :param quantities: A dictionary of (product id, quantity): count
+        """
+        return self.get_pricelist_costs([quantities], customer, currency)[0]
+
+    @classmethod
+    def get_pricelist_carriers_costs(
+            cls, carriers, quantities, customer, currency, workers=None):
+        """Returns the pricelist shipping cost of the same products for many
+        carriers
+
+        The cost is computed once for the carriers sharing a price list.
+        With more than one worker, the price lists are evaluated on a pool
+        of threads, each in its own readonly transaction, so the products
+        must be committed.
 
+        :param carriers: A list of carriers using the pricelist cost method
+        :param quantities: A dictionary of (product id, quantity): count
+        :param customer: The id of the customer party
+        :param currency: The id of the currency of the costs
+        :param workers: The maximum number of threads
+        :returns: A dictionary of carrier id: cost
+        """
+        by_price_list = defaultdict(list)
+        for carrier in carriers:
+            by_price_list[carrier.price_list.id].append(carrier)
+        groups = by_price_list.values()
+
+        if workers > 1 and len(groups) > 1:
+            transaction = Transaction()
+            pool = ThreadPool(min(workers, len(groups)))
+            try:
+                costs = pool.map(cls._get_pricelist_cost_in_transaction, [(
+                    transaction.cursor.database_name, transaction.user,
+                    transaction.context, group[0].id, quantities, customer,
+                    currency,
+                ) for group in groups])
+            finally:
+                pool.close()
+                pool.join()
+        else:
+            costs = [
+                group[0].get_pricelist_cost(quantities, customer, currency)
+                for group in groups
+            ]
+
+        result = {}
+        for group, cost in zip(groups, costs):
+            for carrier in group:
+                result[carrier.id] = cost
+        return result
+
+    @classmethod
+    def get_pricelist_rates(cls, carriers, costs, currency):
+        """Returns the rates of the carriers in the format of `get_rates`
+
+        :param costs: A dictionary of carrier id: cost
+        :param currency: The id of the currency of the costs
+        :returns: A list of tuple: (method, rate, currency, metadata,
+            write_vals)
+        """
+        return [(
+            carrier.party.name, costs[carrier.id], currency, {}, {
+                'carrier_id': carrier.id
+            }
+        ) for carrier in carriers]
+
+    @classmethod
+    @instrument('carrier.quote_pricelist_rates')
+    def quote_pricelist_rates(
+            cls, items, customer, currency, carriers=None, destination=None):
+        """Returns the pricelist shipping rates of products which are not
+        in a stored document, like the items of a cart
+
+        The costs are computed like those of the sales but nothing is
+        written to the database.
+
+        :param items: A list of tuple: (product id, quantity, uom id)
+        :param customer: The id of the customer party
+        :param currency: The id of the currency of the rates
+        :param carriers: A list of carrier ids, defaults to all the carriers
+            using the pricelist cost method
+        :param destination: The id of a party.address or a dictionary with
+            the keys country, subdivision and zip, see :meth:`apply_zone`
+        :returns: A list of tuple: (method, rate, currency, metadata,
+            write_vals)
+        """
+        if not Transaction().context.get('company'):
+            raise UserError("Company not in context.")
+
+        address = cls._get_quote_address(
+            cls._check_quote_destination(destination)
+        )
+        carriers = cls._get_quote_carriers(carriers)
+        costs = cls.get_pricelist_carriers_costs(
+            carriers, cls._get_quote_quantities(items), customer, currency
+        )
+        costs = cls._apply_quote_zones(carriers, costs, currency, address)
+        return cls.get_pricelist_rates(carriers, costs, currency)
+
+    @classmethod
+    def _get_quote_carriers(cls, carrier_ids=None):
+        """Returns the pricelist carriers of the ids or all of them"""
+        if carrier_ids is None:
+            return cls.get_pricelist_carriers()
+        return [
+            c for c in cls.browse(carrier_ids)
+            if c.carrier_cost_method == 'pricelist'
+        ]
+
+    @classmethod
+    def _get_quote_quantities(cls, items):
+        """Group the items of a quote, see :meth:`group_pricelist_quantities`
+
+        :param items: A list of tuple: (product id, quantity, uom id)
+        """
+        return cls.group_pricelist_quantities(
+            (product, quantity, uom, 1)
+            for product, quantity, uom in items
+            if product and quantity
+        )
+
+    @staticmethod
+    def _get_quote_error(exception):
+        "Returns the message of the error of a cart"
+        if isinstance(exception, UserError):
+            return exception.message
+        return '%s: %s' % (exception.__class__.__name__, exception)
+
+    @staticmethod
+    def _check_quote_destination(destination):
+        """Check the shape of the destination of a quote and the types of its
+        ids before any query is run with them
+
+        :returns: The destination
+        """
+        if destination is None or _is_id(destination):
+            return destination
+        if not isinstance(destination, dict) \
+                or set(destination) - set(['country', 'subdivision', 'zip']) \
+                or not _is_id(destination.get('country')) \
+                or (destination.get('subdivision') is not None
+                    and not _is_id(destination['subdivision'])) \
+                or not isinstance(
+                    destination.get('zip'), (basestring, type(None))):
+            raise UserError("Invalid destination: %r" % (destination,))
+        return destination
+
+    @staticmethod
+    def _get_quote_address(destination):
+        """Returns the party.address of the destination of a quote, a
+        dictionary gives an address which is not saved
+
+        :param destination: A destination checked by
+            :meth:`_check_quote_destination`
+        """
+        Address = Pool().get('party.address')
+
+        if destination is None:
+            return
+        if isinstance(destination, dict):
+            values = {'subdivision': None, 'zip': None}
+            values.update(destination)
+            return Address(**values)
+        if not Address.search([('id', '=', destination)], count=True):
+            raise UserError("Unknown address: %s" % destination)
+        return Address(destination)
+
+    @staticmethod
+    def _apply_quote_zones(carriers, costs, currency, address):
+        """Returns the costs of the carriers combined with the zone of the
+        destination of a quote
+
+        :param costs: A dictionary of carrier id: cost
+        :param address: A party.address or None
+        """
+        if address is None:
+            return costs
+        return dict(
+            (c.id, c.apply_zone(costs[c.id], currency, address))
+            for c in carriers
+        )
+
+    @classmethod
+    def _check_quote_cart(cls, cart):
+        """Check the shape of a cart and the types of its ids before any
+        query is run with them
+
+        :returns: A tuple of (customer, currency, list of tuple (product id,
+            quantity, uom id), destination)
+        """
+        if not isinstance(cart, dict):
+            raise UserError("A cart must be a dictionary: %r" % (cart,))
+        customer, currency = cart['customer'], cart['currency']
+        if not _is_id(customer) or not _is_id(currency):
+            raise UserError("Invalid customer or currency: %r, %r" % (
+                customer, currency
+            ))
+        items = []
+        for item in cart['items'] or []:
+            if not isinstance(item, (list, tuple)) or len(item) != 3:
+                raise UserError("Invalid item: %r" % (item,))
+            product, quantity, uom = item
+            if (product and not _is_id(product)) \
+                    or (uom is not None and not _is_id(uom)) \
+                    or isinstance(quantity, bool) \
+                    or not isinstance(
+                        quantity, (int, long, float, Decimal, type(None))):
+                raise UserError("Invalid item: %r" % (item,))
+            items.append((product, quantity, uom))
+        destination = cls._check_quote_destination(cart.get('destination'))
+        return customer, currency, items, destination
+
+    @classmethod
+    def _group_quote_carts(cls, carts):
+        """Group the carts by (customer, currency)
+
+        The carts are checked one by one so that an invalid cart never
+        reaches the database.
+
+        :returns: A tuple of a dictionary of (customer, currency): list of
+            tuple (cart index, quantities, destination) and a dictionary of
+            cart index: error of the invalid carts
+        """
+        Product = Pool().get('product.product')
+
+        valid, errors = {}, {}
+        for index, cart in enumerate(carts):
+            try:
+                valid[index] = cls._check_quote_cart(cart)
+            except Exception as exception:
+                errors[index] = cls._get_quote_error(exception)
+
+        product_ids = set(
+            item[0] for _, _, items, _ in valid.itervalues() for item in items
+            if item[0]
+        )
+        existing = set(map(int, Product.search([
+            ('id', 'in', list(product_ids)),
+        ]))) if product_ids else set()
+
+        groups = defaultdict(list)
+        for index in sorted(valid):
+            customer, currency, items, destination = valid[index]
+            try:
+                unknown = set(item[0] for item in items if item[0]) - existing
+                if unknown:
+                    raise UserError("Unknown products: %s" % sorted(unknown))
+                groups[(customer, currency)].append(
+                    (index, cls._get_quote_quantities(items), destination)
+                )
+            except Exception as exception:
+                errors[index] = cls._get_quote_error(exception)
+        return groups, errors
+
+    @classmethod
+    def _get_quote_costs(cls, carriers, quantities, customer, currency):
+        """Returns the costs of many groups of products for the carriers
+
+        The products of all the groups are priced once per price list.
+
+        :returns: A list in the order of the quantities of dictionary of
+            carrier id: cost
+        """
+        by_price_list = defaultdict(list)
+        for carrier in carriers:
+            by_price_list[carrier.price_list.id].append(carrier)
+
+        costs = [{} for _ in quantities]
+        for group in by_price_list.itervalues():
+            group_costs = group[0].get_pricelist_costs(
+                quantities, customer, currency
+            )
+            for cart_costs, cost in zip(costs, group_costs):
+                cart_costs.update((carrier.id, cost) for carrier in group)
+        return costs
+
+    @classmethod
+    @instrument('carrier.quote_pricelist_rates_batch')
+    def quote_pricelist_rates_batch(cls, carts, carriers=None):
+        """Returns the pricelist shipping rates of many carts at once
+
+        The carts are grouped by (customer, currency) and the products of each
+        group are priced once per price list. The zone of the destination of
+        a cart is applied to its own costs. A cart which can not be quoted
+        gets its error without failing the other carts.
+
+        :param carts: A list of dictionary with the keys items (a list of
+            tuple: (product id, quantity, uom id)), customer, currency and
+            optionally destination, see :meth:`quote_pricelist_rates`
+        :param carriers: A list of carrier ids, defaults to all the carriers
+            using the pricelist cost method
+        :returns: A list in the order of the carts of dictionary with either
+            the key rates, see :meth:`quote_pricelist_rates`, or error
+        """
+        if not Transaction().context.get('company'):
+            raise UserError("Company not in context.")
+
+        carriers = cls._get_quote_carriers(carriers)
+        groups, errors = cls._group_quote_carts(carts)
+        results = [None] * len(carts)
+        for index, error in errors.iteritems():
+            results[index] = {'error': error}
+
+        for (customer, currency), entries in groups.iteritems():
+            try:
+                costs = cls._get_quote_costs(
+                    carriers, [q for _, q, _ in entries], customer, currency
+                )
+            except Exception:
+                # Quote the carts one by one to isolate the failing ones
+                costs = [None] * len(entries)
+            for (index, quantities, destination), cart_costs in zip(
+                    entries, costs):
+                try:
+                    if cart_costs is None:
+                        cart_costs, = cls._get_quote_costs(
+                            carriers, [quantities], customer, currency
+                        )
+                    cart_costs = cls._apply_quote_zones(
+                        carriers, cart_costs, currency,
+                        cls._get_quote_address(destination)
+                    )
+                    results[index] = {
+                        'rates': cls.get_pricelist_rates(
+                            carriers, cart_costs, currency
+                        ),
+                    }
+                except Exception as exception:
+                    results[index] = {
+                        'error': cls._get_quote_error(exception),
+                    }
+        return results
+
+    @classmethod
+    def _get_pricelist_cost_in_transaction(cls, args):
+        "Compute the pricelist cost of a carrier in a new transaction"
+        (database_name, user, context, carrier_id, quantities, customer,
+            currency) = args
+        with Transaction().start(
+                database_name, user, readonly=True, context=context):
+            return cls(carrier_id).get_pricelist_cost(
+                quantities, customer, currency
+            )
+
+    def get_pricelist_cost_incremental(
+            self, state, quantities, customer, currency):
+        """Returns the pricelist shipping cost of the products by adjusting
+        the cost last computed for the same state with the changed
+        quantities only
+
+        The contribution of each (product, quantity) and the running total
+        are kept in the process, so only the products of the lines added or
+        changed since the last call are priced.
+
+        :param state: A hashable identifying the document being edited
+        :param quantities: A dictionary of (product id, quantity): count
+        :param customer: The id of the customer party
+        :param currency: The id of the currency of the cost
+        """
+        Date = Pool().get('ir.date')
+
+        cache = self._pricelist_estimates_cache
+        date = Transaction().context.get('sale_date') or Date.today()
+        key = (
+            state, self.price_list.id, customer, currency,
+            Transaction().user, Transaction().context.get('company'), date,
+        )
+
+        previous, contributions, total = cache.get(
+            key, default=({}, {}, Decimal('0'))
+        )
+        contributions = dict(contributions)
+
+        changes = {}
+        for line_key in set(previous) | set(quantities):
+            delta = quantities.get(line_key, 0) - previous.get(line_key, 0)
+            if delta:
+                changes[line_key] = delta
+
+        missing = set(
+            product_id for product_id, quantity in changes
+            if (product_id, quantity) not in contributions
+        )
+        if missing:
+            prices = self.get_pricelist_prices(missing, customer, currency)
+            for product_id, quantity in changes:
+                if (product_id, quantity) not in contributions:
+                    contributions[(product_id, quantity)] = \
+                        prices[product_id] * Decimal(quantity)
+
+        for line_key, delta in changes.iteritems():
+            total += contributions[line_key] * delta
+
+        for line_key in contributions.keys():
+            if line_key not in quantities:
+                del contributions[line_key]
+        cache.set(key, (dict(quantities), contributions, total))
+        return total
+
+    def get_tier_breakpoints(self):
+        """Returns the sorted breakpoints of the tiers of the carrier
+
+        The tiers are read once per transaction.
+
+        :returns: A dictionary of measure: tuple of (list of maximums sorted
+            in ascending order, list of prices)
+        """
+        Tier = Pool().get('carrier.tier')
+
+        breakpoints = self._tiers_cache.get(self.id)
+        if breakpoints is None:
+            breakpoints = {}
+            for tier in Tier.search([('carrier', '=', self.id)], order=[
+                        ('measure', 'ASC'), ('maximum', 'ASC'),
+                    ]):
+                maximums, prices = breakpoints.setdefault(
+                    tier.measure, ([], [])
+                )
+                maximums.append(float(tier.maximum))
+                prices.append(tier.price)
+            self._tiers_cache.set(self.id, breakpoints)
+        return breakpoints
+
+    def _get_tier_product_measures(self, product_ids):
+        """Returns the weight and the volume of a unit of the products in
+        the units of the carrier
+
+        The measures of a unit are read from the product measurements once
+        per transaction. The volume is the product of the dimensions. Only
+        the measures the carrier has tiers for are required, services have
+        none.
+
+        :param product_ids: A list of product.product ids
+        :returns: A dictionary of product id: dictionary of measure: value
+        """
+        Product = Pool().get('product.product')
+
+        cache = self._tier_measures_cache
+        weight_uom, volume_uom = self.tier_weight_uom, self.tier_volume_uom
+        names = tuple(sorted(self.get_tier_breakpoints()))
+        if 'weight' in names and not weight_uom \
+                or 'volume' in names and not volume_uom:
+            raise UserError(
+                "The carrier %s has no unit for its tiers." % self.rec_name
+            )
+
+        def key(product_id):
+            return (
+                product_id, names, weight_uom and weight_uom.id,
+                volume_uom and volume_uom.id,
+            )
+
+        measures = {}
+        missing = []
+        for product_id in product_ids:
+            value = cache.get(key(product_id))
+            if value is None:
+                missing.append(product_id)
+            else:
+                measures[product_id] = value
+
+        for product in Product.browse(missing):
+            value = dict.fromkeys(names, 0.0)
+            if product.type != 'service':
+                if 'weight' in names:
+                    value['weight'] = self._get_tier_weight(product)
+                if 'volume' in names:
+                    value['volume'] = self._get_tier_volume(product)
+            measures[product.id] = cache.set(key(product.id), value)
+        return measures
+
+    def _get_tier_weight(self, product):
+        """Returns the weight of a unit of the product in the weight unit of
+        the carrier, like the get_weight of the sale lines
+        """
+        Uom = Pool().get('product.uom')
+
+        if not product.weight or not product.weight_uom:
+            raise UserError(
+                "Weight is missing on the product %s" % product.rec_name
+            )
+        return Uom.compute_qty(
+            product.weight_uom, product.weight, self.tier_weight_uom,
+            round=False
+        )
+
+    def _get_tier_volume(self, product):
+        """Returns the volume of a unit of the product in the volume unit of
+        the carrier from its dimensions
+        """
+        pool = Pool()
+        Uom = pool.get('product.uom')
+        ModelData = pool.get('ir.model.data')
+
+        dimensions = [
+            (product.length, product.length_uom),
+            (product.height, product.height_uom),
+            (product.width, product.width_uom),
+        ]
+        if not all(v and u for v, u in dimensions):
+            raise UserError(
+                "Dimensions are missing on the product %s" % product.rec_name
+            )
+        meter = Uom(ModelData.get_id('product', 'uom_meter'))
+        cubic_meter = Uom(ModelData.get_id('product', 'uom_cubic_meter'))
+        volume = 1.0
+        for value, uom in dimensions:
+            volume *= Uom.compute_qty(uom, value, meter, round=False)
+        return Uom.compute_qty(
+            cubic_meter, volume, self.tier_volume_uom, round=False
+        )
+
+    def get_tier_measures(self, quantities):
+        """Returns the total weight and volume of the quantities in the
+        units of the carrier
+
+        :param quantities: A dictionary of (product id, quantity in the
+            default unit of the product): count, see
+            :meth:`group_pricelist_quantities`
+        :returns: A dictionary of measure: total rounded with the rounding
+            of the unit of the carrier
+        """
+        Uom = Pool().get('product.uom')
+
+        measures = self._get_tier_product_measures(
+            set(product_id for product_id, _ in quantities)
+        )
+        totals = dict.fromkeys(self.get_tier_breakpoints(), 0.0)
+        for (product_id, quantity), count in quantities.iteritems():
+            for name, value in measures[product_id].iteritems():
+                totals[name] += value * quantity * count
+        for name, uom in [
+                ('weight', self.tier_weight_uom),
+                ('volume', self.tier_volume_uom)]:
+            if name in totals:
+                totals[name] = Uom.round(totals[name], uom.rounding)
+        return totals
+
+    @staticmethod
+    def get_tier_price(maximums, prices, value):
+        """Returns the price of the band of the value
+
+        The band is found with a binary search of the sorted maximums.
+
+        :returns: The price or None if the value exceeds the last band
+        """
+        index = bisect_left(maximums, value)
+        if index == len(maximums):
+            return
+        return prices[index]
+
+    @instrument('carrier.get_tier_cost')
+    def get_tier_cost(self, quantities):
+        """Returns the shipping cost of the quantities from the tiers of the
+        carrier
+
+        The cost is the price of the band of the total weight or of the
+        total volume, whichever is higher when the carrier has tiers for
+        both. It is in the currency of the company.
+
+        :param quantities: A dictionary of (product id, quantity in the
+            default unit of the product): count
+        """
+        totals = self.get_tier_measures(quantities)
+        cost = Decimal('0')
+        for name, (maximums, prices) in \
+                sorted(self.get_tier_breakpoints().iteritems()):
+            price = self.get_tier_price(maximums, prices, totals[name])
+            if price is None:
+                raise UserError(
+                    "The %s %s exceeds the tiers of the carrier %s." % (
+                        name, totals[name], self.rec_name
+                    )
+                )
+            cost = max(cost, price)
+        counters.incr('carrier.tier_cost')
+        return cost
+
+    def _get_tier_sale_price(self):
+        """Returns the tier cost of the sale or the shipment of the context
+
+        :returns: A tuple of (value, currency_id)
+        """
+        Sale = Pool().get('sale.sale')
+        Shipment = Pool().get('stock.shipment.out')
+        Company = Pool().get('company.company')
+
+        context = Transaction().context
+        currency = Company(context['company']).currency.id
+
+        if context.get('tier_shipping_quantities') is not None:
+            # The quantities of the lines being edited passed by the sale
+            quantities = context['tier_shipping_quantities']
+        elif context.get('sale'):
+            quantities = Sale.get_pricelist_shipping_quantities(
+                [Sale(context['sale'])]
+            )[context['sale']]
+        elif context.get('shipment'):
+            quantities = Shipment.get_pricelist_shipping_quantities(
+                [Shipment(context['shipment'])]
+            )[context['shipment']]
+        else:
+            return Decimal('0'), currency
+        return self.get_tier_cost(quantities), currency
+
+    def get_zone_index(self):
+        """Returns the index of the zones of the carrier
+
+        The index is built once per process for each database and cleared
+        when a zone changes. A key shared by many zones belongs to the first
+        one by sequence.
+
+        :returns: A dictionary of (country id, subdivision id, zip prefix):
+            (multiplier, surcharge), the subdivision and the prefix being
+            None for the keys of a country
+        """
+        index = self._zones_cache.get(self.id)
+        if index is None:
+            index = {}
+            for zone in self.zones:
+                keys = [(c.id, None, None) for c in zone.countries]
+                keys += [(s.country.id, s.id, None) for s in zone.subdivisions]
+                keys += [
+                    (z.country.id, None, normalize_zip(z.prefix))
+                    for z in zone.zips
+                ]
+                for key in keys:
+                    index.setdefault(key, (zone.multiplier, zone.surcharge))
+            self._zones_cache.set(self.id, index)
+        return index
+
+    def get_zone(self, address):
+        """Returns the multiplier and the surcharge of the zone of the
+        address
+
+        The prefixes of the zip are looked up from the longest one, then the
+        subdivision and the country of the address, each with a lookup in
+        the index of :meth:`get_zone_index`.
+
+        :returns: A tuple of (multiplier, surcharge) or None when the address
+            is in no zone
+        """
+        if not address or not address.country:
+            return
+        index = self.get_zone_index()
+        if not index:
+            return
+
+        country = address.country.id
+        code = normalize_zip(address.zip)
+        for length in range(len(code), 0, -1):
+            if (country, None, code[:length]) in index:
+                return index[(country, None, code[:length])]
+        if address.subdivision \
+                and (country, address.subdivision.id, None) in index:
+            return index[(country, address.subdivision.id, None)]
+        return index.get((country, None, None))
+
+    def apply_zone(self, cost, currency, address):
+        """Returns the pricelist shipping cost combined with the zone of the
+        address
+
+        The cost is multiplied by the multiplier of the zone and increased
+        by its surcharge, converted from the currency of the company of the
+        price list. The cost of an address in no zone is left unchanged.
+
+        :param cost: The cost computed from the price list
+        :param currency: The id of the currency of the cost
+        :param address: A party.address or None
+        """
+        zone = self.get_zone(address)
+        if zone is None:
+            return cost
+        multiplier, surcharge = zone
+        if surcharge:
+            surcharge, = self.convert_pricelist_costs([(
+                surcharge, self.price_list.company.currency.id, currency
+            )])
+        counters.incr('carrier.zone_cost')
+        return cost * multiplier + surcharge
+
+    @instrument('carrier.get_rates')
     def get_rates(self):
         """Returns a list of tuple: (method, rate, currency, metadata)
         """
@@ -44,8 +1332,9 @@ class Carrier:
         if not sale or self.carrier_cost_method != 'pricelist':
             return super(Carrier, self).get_rates()
 
-        return Sale(sale).get_pricelist_shipping_rates()
+        return Sale(sale).get_pricelist_shipping_rates(carrier=self)
 
+    @instrument('carrier.get_sale_price')
     def get_sale_price(self):
         """Estimates the shipment rate for the current shipment
 
@@ -67,6 +1356,14 @@ class Carrier:
 
         default_currency = Company(company).currency
 
+        if self.carrier_cost_method == 'tier':
+            return self._get_tier_sale_price()
+
+        estimate = Transaction().context.get('pricelist_shipping_estimate')
+        if estimate and self.carrier_cost_method == 'pricelist':
+            # The cost of the lines being edited computed by the sale
+            return estimate
+
         if not sale and not shipment:
             return Decimal('0'), default_currency.id
 
@@ -74,9 +1371,13 @@ class Carrier:
             return super(Carrier, self).get_sale_price()
 
         if sale:
-            return Sale(sale).get_pricelist_shipping_cost()
+            return Sale(sale).get_pricelist_shipping_cost(carrier=self)
 
         if shipment:
-            return Shipment(shipment).get_pricelist_shipping_cost()
+            if Transaction().context.get('pricelist_shipping_batch'):
+                # The cost of the shipments created by the processing of the
+                # sales is computed for all of them, see `Sale.process`
+                return Decimal('0'), default_currency.id
+            return Shipment(shipment).get_pricelist_shipping_cost(carrier=self)
 
         return Decimal('0'), default_currency.id
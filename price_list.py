@@ -0,0 +1,273 @@
+# -*- coding: utf-8 -*-
+"""
+    price_list.py
+
+    :copyright: (c) 2014 by Openlabs Technologies & Consulting (P) Limited
+    :license: BSD, see LICENSE for more details.
+"""
+import ast
+import operator
+from decimal import Decimal, InvalidOperation
+
+from trytond.pool import PoolMeta, Pool
+from trytond.cache import Cache
+from trytond.transaction import Transaction
+from trytond.tools.misc import _compile_source
+from trytond.modules.product_price_list.price_list import decistmt
+
+__metaclass__ = PoolMeta
+__all__ = ['PriceList', 'PriceListLine', 'fold_formula']
+
+# The builtins available to the formulas, as in trytond.tools.safe_eval
+SAFE_BUILTINS = {
+    'True': True,
+    'False': False,
+    'str': str,
+    'globals': locals,
+    'locals': locals,
+    'bool': bool,
+    'dict': dict,
+    'round': round,
+    'Decimal': Decimal,
+}
+# A formula using only these names does not depend on the product
+CONSTANT_NAMES = frozenset([
+    'True', 'False', 'str', 'bool', 'dict', 'round', 'Decimal',
+])
+
+# A formula using only these names depends only on the product
+PRODUCT_NAMES = CONSTANT_NAMES | frozenset(['unit_price'])
+
+# The value of an expression which is not known before the evaluation
+UNKNOWN = object()
+
+
+# The operators folded on constant values
+UNARY_OPERATORS = {
+    ast.USub: operator.neg,
+    ast.UAdd: operator.pos,
+}
+BINARY_OPERATORS = {
+    ast.Add: operator.add,
+    ast.Sub: operator.sub,
+    ast.Mult: operator.mul,
+    ast.Div: operator.truediv,
+}
+
+
+def _fold_decimal(node):
+    "Returns the value of a Decimal('...') call or UNKNOWN"
+    if not isinstance(node.func, ast.Name) or node.func.id != 'Decimal' \
+            or len(node.args) != 1 or node.keywords or node.starargs \
+            or node.kwargs:
+        return UNKNOWN
+    arg, = node.args
+    try:
+        if isinstance(arg, ast.Str):
+            return Decimal(arg.s)
+        if isinstance(arg, ast.Num):
+            return Decimal(arg.n)
+    except InvalidOperation:
+        pass
+    return UNKNOWN
+
+
+def _fold_binary(node):
+    "Returns the value of a binary operation or UNKNOWN"
+    left, right = fold_formula(node.left), fold_formula(node.right)
+    if isinstance(node.op, ast.Mult) and any(
+            v is not UNKNOWN and v.is_zero() for v in (left, right)):
+        return Decimal('0')
+    if left is UNKNOWN or right is UNKNOWN:
+        return UNKNOWN
+    try:
+        return BINARY_OPERATORS[type(node.op)](left, right)
+    except ArithmeticError:
+        return UNKNOWN
+
+
+def fold_formula(node):
+    """Returns the value of a formula expression, parsed by ast, which is
+    the same for any unit_price or UNKNOWN
+
+    A product by zero, like in ``(unit_price * 0.0) + 5``, is folded to
+    zero.
+    """
+    if isinstance(node, ast.Expression):
+        return fold_formula(node.body)
+    if isinstance(node, ast.Num):
+        return Decimal(node.n)
+    if isinstance(node, ast.Call):
+        return _fold_decimal(node)
+    if isinstance(node, ast.UnaryOp) and type(node.op) in UNARY_OPERATORS:
+        operand = fold_formula(node.operand)
+        if operand is UNKNOWN:
+            return UNKNOWN
+        return UNARY_OPERATORS[type(node.op)](operand)
+    if isinstance(node, ast.BinOp) and type(node.op) in BINARY_OPERATORS:
+        return _fold_binary(node)
+    return UNKNOWN
+
+
+def clear_pricelist_caches():
+    "Clear the carrier caches depending on the price lists"
+    Carrier = Pool().get('carrier')
+
+    Carrier.clear_pricelist_caches()
+
+
+def update_pricelist_kinds(price_lists, products=None):
+    """Classify again the price lists of the carriers using them
+
+    :param products: The products whose rates may have changed, defaults to
+        all the products
+    """
+    Carrier = Pool().get('carrier')
+
+    price_list_ids = list(set(int(p) for p in price_lists))
+    if price_list_ids:
+        Carrier.update_pricelist_kinds(Carrier.search([
+            ('price_list', 'in', price_list_ids),
+        ]), products)
+
+
+def get_pricelist_products(lines):
+    """Returns the products whose price may change with the lines
+
+    :returns: A list of products or None for all the products when a line
+        matches any product
+    """
+    Product = Pool().get('product.product')
+
+    product_ids = set()
+    for line in lines:
+        if not line.product:
+            return
+        product_ids.add(line.product.id)
+    return Product.browse(list(product_ids))
+
+
+class PriceList:
+    __name__ = 'product.price_list'
+
+    @classmethod
+    def create(cls, vlist):
+        clear_pricelist_caches()
+        return super(PriceList, cls).create(vlist)
+
+    @classmethod
+    def write(cls, *args):
+        clear_pricelist_caches()
+        super(PriceList, cls).write(*args)
+
+        # The changes of the lines are handled by the lines
+        actions = iter(args)
+        update_pricelist_kinds(sum([
+            price_lists for price_lists, values in zip(actions, actions)
+            if 'company' in values
+        ], []))
+
+    @classmethod
+    def delete(cls, price_lists):
+        clear_pricelist_caches()
+        return super(PriceList, cls).delete(price_lists)
+
+
+class PriceListLine:
+    __name__ = 'product.price_list.line'
+
+    _formula_cache = Cache(
+        'product.price_list.line.formula', size_limit=10240, context=False
+    )
+
+    @classmethod
+    def create(cls, vlist):
+        clear_pricelist_caches()
+        lines = super(PriceListLine, cls).create(vlist)
+        update_pricelist_kinds(
+            [line.price_list for line in lines], get_pricelist_products(lines)
+        )
+        return lines
+
+    @classmethod
+    def write(cls, *args):
+        clear_pricelist_caches()
+        lines = sum(args[::2], [])
+        price_lists = [line.price_list for line in lines]
+        price_lists += [
+            v['price_list'] for v in args[1::2] if v.get('price_list')
+        ]
+        # The products matched before and after the change
+        before = get_pricelist_products(lines)
+        super(PriceListLine, cls).write(*args)
+        after = get_pricelist_products(cls.browse(lines))
+        products = None
+        if before is not None and after is not None:
+            products = list(set(before + after))
+        update_pricelist_kinds(price_lists, products)
+
+    @classmethod
+    def delete(cls, lines):
+        clear_pricelist_caches()
+        price_lists = [line.price_list for line in lines]
+        products = get_pricelist_products(lines)
+        super(PriceListLine, cls).delete(lines)
+        update_pricelist_kinds(price_lists, products)
+
+    def _get_compiled_formula(self):
+        """Returns the formula compiled once for each version of the line
+
+        The compiled formulas are cached by line id and write date.
+
+        :returns: A tuple of (code, value) where value is the result of the
+            formula when it does not depend on the context or else None
+        """
+        key = (self.id, self.write_date)
+        if self.id is not None and self.id >= 0:
+            cached = self._formula_cache.get(key)
+            if cached is not None and cached[0] == self.formula:
+                return cached[1:]
+
+        source = decistmt(self.formula)
+        if '__' in source:
+            raise ValueError('Double underscores not allowed')
+        code = _compile_source(source)
+
+        value = None
+        if CONSTANT_NAMES.issuperset(code.co_names):
+            value = eval(code, {'__builtins__': SAFE_BUILTINS}, {
+                'Decimal': Decimal,
+            })
+
+        if self.id is not None and self.id >= 0:
+            self._formula_cache.set(key, (self.formula, code, value))
+        return code, value
+
+    def is_product_formula(self):
+        "Returns True if the formula depends only on the product"
+        code, _ = self._get_compiled_formula()
+        return PRODUCT_NAMES.issuperset(code.co_names)
+
+    def get_constant_unit_price(self):
+        """Returns the unit price of the line when it is the same for every
+        product or else None
+        """
+        code, value = self._get_compiled_formula()
+        if value is not None:
+            return value
+        if not self.is_product_formula():
+            return
+        value = fold_formula(ast.parse(decistmt(self.formula), mode='eval'))
+        if value is not UNKNOWN:
+            return value
+
+    def get_unit_price(self):
+        """
+        Return unit price (as Decimal) evaluating the compiled formula
+        """
+        code, value = self._get_compiled_formula()
+        if value is not None:
+            return value
+        context = Transaction().context.copy()
+        context['Decimal'] = Decimal
+        return eval(code, {'__builtins__': SAFE_BUILTINS}, context)
@@ -0,0 +1,82 @@
+# -*- coding: utf-8 -*-
+"""
+    product.py
+
+    :copyright: (c) 2014 by Openlabs Technologies & Consulting (P) Limited
+    :license: BSD, see LICENSE for more details.
+"""
+from trytond.pool import PoolMeta, Pool
+from trytond.transaction import Transaction
+
+from price_list import clear_pricelist_caches
+
+__metaclass__ = PoolMeta
+__all__ = ['Template', 'Product']
+
+# The fields on which the unit shipping rate of a product may depend
+TEMPLATE_PRICING_FIELDS = frozenset(['list_price', 'default_uom', 'category'])
+PRODUCT_PRICING_FIELDS = frozenset(['template'])
+
+
+def refresh_pricelist_rates(products):
+    """Refresh the materialized rates of the products for all the carriers,
+    whatever the company of the user
+    """
+    Carrier = Pool().get('carrier')
+    Rate = Pool().get('carrier.pricelist.rate')
+
+    if products:
+        with Transaction().set_user(0):
+            carriers = Carrier.search([
+                ('carrier_cost_method', '=', 'pricelist'),
+                ('pricelist_kind', '=', 'product'),
+            ])
+        Rate.refresh(carriers, products)
+
+
+class Template:
+    __name__ = 'product.template'
+
+    @classmethod
+    def write(cls, *args):
+        clear_pricelist_caches()
+        super(Template, cls).write(*args)
+
+        actions = iter(args)
+        refresh_pricelist_rates([
+            product for templates, values in zip(actions, actions)
+            if TEMPLATE_PRICING_FIELDS.intersection(values)
+            for template in templates
+            for product in template.products
+        ])
+
+    @classmethod
+    def delete(cls, templates):
+        clear_pricelist_caches()
+        return super(Template, cls).delete(templates)
+
+
+class Product:
+    __name__ = 'product.product'
+
+    @classmethod
+    def create(cls, vlist):
+        products = super(Product, cls).create(vlist)
+        refresh_pricelist_rates(products)
+        return products
+
+    @classmethod
+    def write(cls, *args):
+        clear_pricelist_caches()
+        super(Product, cls).write(*args)
+
+        actions = iter(args)
+        refresh_pricelist_rates(sum([
+            products for products, values in zip(actions, actions)
+            if PRODUCT_PRICING_FIELDS.intersection(values)
+        ], []))
+
+    @classmethod
+    def delete(cls, products):
+        clear_pricelist_caches()
+        return super(Product, cls).delete(products)
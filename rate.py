@@ -0,0 +1,236 @@
+# -*- coding: utf-8 -*-
+"""
+    rate.py
+
+    :copyright: (c) 2014 by Openlabs Technologies & Consulting (P) Limited
+    :license: BSD, see LICENSE for more details.
+"""
+from decimal import Decimal
+from collections import defaultdict
+from contextlib import contextmanager
+
+from sql import Cast
+from sql.aggregate import Count, Sum
+from sql.functions import CurrentTimestamp
+
+from trytond.model import ModelSQL, fields
+from trytond.pool import Pool
+from trytond.transaction import Transaction
+from trytond.tools import reduce_ids
+
+from stats import counters, measure, note
+
+__all__ = ['CarrierPricelistRate']
+
+# The number of products priced together when the rates are refreshed
+REFRESH_BATCH_SIZE = 1000
+
+
+class CarrierPricelistRate(ModelSQL):
+    """
+    Carrier Pricelist Rate
+
+    The unit shipping rate of each product in its default unit for the
+    carriers whose price list depends only on the product. The rates are in
+    the currency of the company of the price list.
+    """
+    __name__ = 'carrier.pricelist.rate'
+
+    carrier = fields.Many2One(
+        'carrier', 'Carrier', required=True, select=True, ondelete='CASCADE'
+    )
+    product = fields.Many2One(
+        'product.product', 'Product', required=True, select=True,
+        ondelete='CASCADE'
+    )
+    uom = fields.Many2One(
+        'product.uom', 'UOM', required=True, ondelete='CASCADE'
+    )
+    rate = fields.Numeric('Rate', required=True)
+
+    @classmethod
+    def __setup__(cls):
+        super(CarrierPricelistRate, cls).__setup__()
+        cls._sql_constraints += [
+            ('carrier_product_uom_uniq', 'UNIQUE(carrier, product, uom)',
+                'The rate of a product must be unique per carrier and UOM.'),
+        ]
+
+    @staticmethod
+    def materialized(carrier):
+        "Returns True if the rates of the carrier are materialized"
+        return carrier.carrier_cost_method == 'pricelist' \
+            and carrier.pricelist_kind == 'product'
+
+    @classmethod
+    def refresh(cls, carriers, products=None):
+        """Compute again the rates of the carriers
+
+        The rates are computed as root, and the prices as the user of the
+        cron with the company of the price list of each carrier, so that the
+        record rules of the user, or the missing company of the cron user,
+        never hide a price list nor the list prices of its company.
+
+        :param carriers: The carriers whose rates are refreshed, the rates of
+            those which are not materialized are deleted
+        :param products: The products whose rates are refreshed, defaults to
+            all the products
+        """
+        Carrier = Pool().get('carrier')
+        Product = Pool().get('product.product')
+
+        if not carriers or products is not None and not products:
+            return
+
+        with Transaction().set_user(0):
+            carriers = Carrier.browse([c.id for c in carriers])
+            if products is not None:
+                products = Product.browse([p.id for p in products])
+            cls._refresh(carriers, products)
+
+    @classmethod
+    def _refresh(cls, carriers, products=None):
+        "Compute again the rates of the carriers, see :meth:`refresh`"
+        Product = Pool().get('product.product')
+        table = cls.__table__()
+        cursor = Transaction().cursor
+
+        where = reduce_ids(table.carrier, [c.id for c in carriers])
+        if products is None:
+            cursor.execute(*table.delete(where=where))
+        else:
+            product_ids = [p.id for p in products]
+            for i in range(0, len(product_ids), cursor.IN_MAX):
+                sub_ids = product_ids[i:i + cursor.IN_MAX]
+                cursor.execute(*table.delete(
+                    where=where & reduce_ids(table.product, sub_ids)
+                ))
+
+        carriers = [c for c in carriers if cls.materialized(c)]
+        if not carriers:
+            return
+        if products is None:
+            products = Product.search([])
+
+        by_company = defaultdict(list)
+        for carrier in carriers:
+            by_company[carrier.price_list.company.id].append(carrier)
+
+        product_ids = [p.id for p in products]
+        with measure('carrier.pricelist.rate.refresh'):
+            for company, company_carriers in by_company.iteritems():
+                with cls._company_user(company):
+                    for i in range(0, len(product_ids), REFRESH_BATCH_SIZE):
+                        batch = Product.browse(
+                            product_ids[i:i + REFRESH_BATCH_SIZE]
+                        )
+                        note('products', len(batch) * len(company_carriers))
+                        for carrier in company_carriers:
+                            cls._insert_rates(carrier, batch)
+
+    @staticmethod
+    @contextmanager
+    def _company_user(company):
+        """Act as the user of the cron with the company, like the crons of
+        the companies, because the list prices are properties of the company
+        of the user
+
+        It must be called as root.
+        """
+        pool = Pool()
+        ModelData = pool.get('ir.model.data')
+        User = pool.get('res.user')
+
+        user = User(ModelData.get_id(
+            'carrier_pricelist', 'user_carrier_pricelist_cron'
+        ))
+        User.write([user], {
+            'company': company,
+            'main_company': company,
+        })
+        try:
+            with Transaction().set_user(user.id), \
+                    Transaction().set_context(company=company):
+                yield
+        finally:
+            User.write([user], {
+                'company': None,
+                'main_company': None,
+            })
+
+    @classmethod
+    def _insert_rates(cls, carrier, products):
+        "Insert the rates of the products for the carrier"
+        Product = Pool().get('product.product')
+        table = cls.__table__()
+        cursor = Transaction().cursor
+
+        company = carrier.price_list.company
+        with Transaction().set_context(
+                company=company.id, customer=company.party.id,
+                price_list=carrier.price_list.id,
+                currency=company.currency.id):
+            prices = Product.get_sale_price(products)
+        cursor.execute(*table.insert([
+            table.create_uid, table.create_date, table.carrier,
+            table.product, table.uom, table.rate,
+        ], [[
+            Transaction().user, CurrentTimestamp(), carrier.id, product.id,
+            product.default_uom.id, prices[product.id],
+        ] for product in products]))
+
+    @classmethod
+    def rebuild(cls):
+        "Rebuild the rates of all the carriers, called by a cron"
+        Carrier = Pool().get('carrier')
+
+        with Transaction().set_user(0):
+            carriers = Carrier.search([
+                ('carrier_cost_method', '=', 'pricelist'),
+            ])
+        cls.refresh(carriers)
+
+    @classmethod
+    def sum_costs(cls, carrier, currency, lines):
+        """Returns the shipping costs of documents computed as a single SUM
+        of the quantities of their lines times the rates
+
+        The sum is computed by the database, with its numeric arithmetic.
+        The documents having a line without the rate of its product and unit
+        are left to the price list.
+
+        :param carrier: A carrier with materialized rates
+        :param currency: The id of the currency of the costs
+        :param lines: A query with the columns document, product, quantity
+            and unit of the lines of the documents
+        :returns: A dictionary of document: cost
+        """
+        table = cls.__table__()
+        cursor = Transaction().cursor
+
+        if not cls.materialized(carrier) \
+                or carrier.price_list.company.currency.id != currency:
+            return {}
+
+        rate = cls.rate.sql_column(table)
+        query = lines.join(table, 'LEFT', condition=(
+            (table.carrier == carrier.id)
+            & (table.product == lines.product)
+            & (table.uom == lines.unit)
+        )).select(
+            lines.document,
+            Sum(Cast(lines.quantity, cls.rate.sql_type().base) * rate),
+            Count(lines.product) - Count(table.id),
+            group_by=lines.document
+        )
+        cursor.execute(*query)
+
+        costs = {}
+        for document, total, missing in cursor.fetchall():
+            if missing:
+                continue
+            if not isinstance(total, Decimal):
+                total = Decimal(str(total or 0))
+            costs[document] = total
+        counters.incr('carrier.pricelist_cost.materialized', len(costs))
+        return costs
@@ -6,23 +6,50 @@
     :license: BSD, see LICENSE for more details.
 """
 from decimal import Decimal
+from collections import defaultdict
 
+from sql.aggregate import Count
+from sql.functions import CurrentTimestamp
+
+from trytond.model import fields
 from trytond.transaction import Transaction
+from trytond.config import CONFIG
 from trytond.pool import PoolMeta, Pool
 from trytond.exceptions import UserError
+from trytond.tools import reduce_ids
+
+from stats import counters, instrument, measure
 
 __metaclass__ = PoolMeta
 __all__ = ['Sale']
 
+# The number of sales whose shipping lines are computed together by the
+# worker of the deferred mode
+QUEUE_BATCH_SIZE = 100
+
 
 class Sale:
     __name__ = "sale.sale"
 
+    pricelist_shipping_pending = fields.Boolean(
+        'Pricelist Shipping Cost Pending', readonly=True, select=True
+    )
+
+    @staticmethod
+    def default_pricelist_shipping_pending():
+        return False
+
+    @staticmethod
+    def _pricelist_shipping_deferred():
+        """The shipping lines are computed in the background when enabled
+        with carrier_pricelist_deferred = True"""
+        return bool(CONFIG.get('carrier_pricelist_deferred'))
+
     def _get_carrier_context(self):
         "Pass sale in the context"
         context = super(Sale, self)._get_carrier_context()
 
-        if self.carrier.carrier_cost_method != 'pricelist':
+        if self.carrier.carrier_cost_method not in ('pricelist', 'tier'):
             return context
 
         context = context.copy()
@@ -31,58 +58,344 @@ class Sale:
 
     def on_change_lines(self):
         """Pass a flag in context which indicates the get_sale_price method
-        of pricelist carrier not to calculate cost on each line change
+        of pricelist carrier not to calculate cost on each line change.
+
+        The cost of the edited lines is estimated incrementally instead and
+        passed in the context. The quantities of the edited lines are passed
+        to the tier carriers.
         """
-        with Transaction().set_context({'ignore_carrier_computation': True}):
+        context = {'ignore_carrier_computation': True}
+        if self.carrier and self.carrier.carrier_cost_method == 'pricelist':
+            context['pricelist_shipping_estimate'] = \
+                self.get_pricelist_shipping_estimate()
+        elif self.carrier and self.carrier.carrier_cost_method == 'tier':
+            context['tier_shipping_quantities'] = \
+                self._get_pricelist_shipping_quantities()
+        with Transaction().set_context(context):
             return super(Sale, self).on_change_lines()
 
+    def get_pricelist_shipping_estimate(self):
+        """
+        Return the pricelist shipping cost of the lines being edited
+
+        Only the lines added or changed since the last estimate of the sale
+        are priced. The zone of the shipment address is then applied.
+
+        :returns: A tuple of (value, currency_id) or None
+        """
+        if not self.party or not self.currency:
+            return
+        total = self.carrier.get_pricelist_cost_incremental(
+            ('sale.sale', self.id), self._get_pricelist_shipping_quantities(),
+            self.party.id, self.currency.id
+        )
+        return self.carrier.apply_zone(
+            total, self.currency.id, getattr(self, 'shipment_address', None)
+        ), self.currency.id
+
     def update_pricelist_shipment_cost(self):
         "Add a shipping line to sale for pricelist costmethod"
-        Sale = Pool().get('sale.sale')
-        Currency = Pool().get('currency.currency')
+        self.update_pricelist_shipment_costs([self])
 
-        if not self.carrier or self.carrier.carrier_cost_method != 'pricelist':
-            return
+    @classmethod
+    @instrument('sale.update_pricelist_shipment_costs')
+    def update_pricelist_shipment_costs(cls, sales):
+        """Add a shipping line to each of the sales for pricelist costmethod
 
-        with Transaction().set_context(self._get_carrier_context()):
-            shipment_cost = self.carrier.get_sale_price()
-        if not shipment_cost[0]:
+        The costs of all the sales are computed with
+        :meth:`get_pricelist_shipping_costs` and converted to the currency of
+        the sales reading each rate once, the shipping lines are then
+        created, updated and the previous ones deleted in a single call each.
+        A shipping line which already has the cost is left untouched.
+
+        The sales are locked by :meth:`lock_pricelist_shipping` before their
+        lines are read so that concurrent updates of a sale end with a single
+        shipping line.
+        """
+        SaleLine = Pool().get('sale.line')
+        Carrier = Pool().get('carrier')
+
+        sales = [
+            sale for sale in sales
+            if sale.carrier and sale.carrier.carrier_cost_method == 'pricelist'
+        ]
+        if not sales:
             return
 
-        shipment_cost = Currency.compute(
-            Currency(shipment_cost[1]), shipment_cost[0], self.currency
+        cls.lock_pricelist_shipping(sales)
+        # Read again the lines which may have been changed before the lock
+        sales = cls.browse(sales)
+
+        costs = cls.get_pricelist_shipping_costs(sales)
+        sales = [sale for sale in sales if costs[sale.id][0]]
+        with measure('currency.compute'):
+            converted = Carrier.convert_pricelist_costs([
+                costs[sale.id] + (sale.currency.id,) for sale in sales
+            ])
+
+        to_create, to_write, to_delete = [], [], []
+        changed = []
+        for sale, cost in zip(sales, converted):
+            lines = [line for line in sale.lines if line.shipment_cost]
+            if len(lines) == 1 and \
+                    lines[0].product == sale.carrier.carrier_product:
+                line, = lines
+                if line.unit_price == cost and line.shipment_cost == cost:
+                    # The shipping line is up to date
+                    counters.incr('sale.shipping_line.skipped')
+                    continue
+                to_write.extend(([line], {
+                    'unit_price': Decimal(cost),
+                    'shipment_cost': Decimal(cost),
+                    'amount': Decimal(cost),
+                }))
+                changed.append(sale)
+                continue
+
+            to_create.append(sale._get_pricelist_shipping_line(cost))
+            to_delete.extend(lines)
+            changed.append(sale)
+
+        with measure('sale.line.write'):
+            if to_create:
+                SaleLine.create(to_create)
+            if to_write:
+                SaleLine.write(*to_write)
+            if to_delete:
+                SaleLine.delete(to_delete)
+        # Only the sales whose shipping line changed are modified
+        cls.lock_pricelist_shipping(changed, touch=True)
+
+    @classmethod
+    def lock_pricelist_shipping(cls, sales, touch=False):
+        """Lock the rows of the sales until the end of the transaction
+
+        The rows are locked by an update, by batches of increasing ids to
+        limit the deadlocks. A transaction updating the shipping line of a
+        sale waits for the one holding the lock and fails with a
+        serialization error if that one committed, so that it is retried
+        with the committed lines instead of adding a second shipping line.
+
+        :param touch: Set the write date of the sales, otherwise the update
+            changes nothing
+        """
+        table = cls.__table__()
+        cursor = Transaction().cursor
+
+        if touch:
+            columns = [table.write_uid, table.write_date]
+            values = [Transaction().user, CurrentTimestamp()]
+        else:
+            columns, values = [table.id], [table.id]
+
+        sale_ids = sorted(set(s.id for s in sales))
+        for i in range(0, len(sale_ids), cursor.IN_MAX):
+            sub_ids = sale_ids[i:i + cursor.IN_MAX]
+            cursor.execute(*table.update(
+                columns=columns, values=values,
+                where=reduce_ids(table.id, sub_ids)
+            ))
+
+    def _get_pricelist_shipping_line(self, shipment_cost):
+        """Return the values to create the shipping line of the sale
+
+        :param shipment_cost: The shipment cost in the currency of the sale
+        """
+        return {
+            'sale': self.id,
+            'type': 'line',
+            'product': self.carrier.carrier_product.id,
+            'description': self.carrier.carrier_product.name,
+            'quantity': 1,  # XXX
+            'unit': self.carrier.carrier_product.sale_uom.id,
+            'unit_price': Decimal(shipment_cost),
+            'shipment_cost': Decimal(shipment_cost),
+            'amount': Decimal(shipment_cost),
+            'taxes': [],
+            'sequence': 9999,  # XXX
+        }
+
+    def _get_pricelist_shipping_rows(self):
+        """Return the lines of the sale record to price. Shipping lines are
+        not priced.
+
+        :returns: A list of tuple: (product id, quantity, unit id, count)
+        """
+        rows = []
+        for line in self.lines or []:
+            if not getattr(line, 'product', None) \
+                    or getattr(line, 'shipment_cost', None) \
+                    or not getattr(line, 'quantity', None):
+                continue
+            unit = getattr(line, 'unit', None)
+            rows.append(
+                (line.product.id, line.quantity, unit and unit.id, 1)
+            )
+        return rows
+
+    def _get_pricelist_shipping_quantities(self):
+        """Group the lines of the sale record by product and quantity so
+        that each distinct product is priced only once.
+
+        :returns: A dictionary of (product id, quantity): line count
+        """
+        Carrier = Pool().get('carrier')
+        return Carrier.group_pricelist_quantities(
+            self._get_pricelist_shipping_rows()
         )
-        Sale.write([self], {
-            'lines': [
-                ('create', [{
-                    'type': 'line',
-                    'product': self.carrier.carrier_product.id,
-                    'description': self.carrier.carrier_product.name,
-                    'quantity': 1,  # XXX
-                    'unit': self.carrier.carrier_product.sale_uom.id,
-                    'unit_price': Decimal(shipment_cost),
-                    'shipment_cost': Decimal(shipment_cost),
-                    'amount': Decimal(shipment_cost),
-                    'taxes': [],
-                    'sequence': 9999,  # XXX
-                }]),
-                ('delete', [
-                    line for line in self.lines if line.shipment_cost
-                ]),
-            ]
-        })
-
-    def get_pricelist_shipping_cost(self):
+
+    @staticmethod
+    def _get_pricelist_shipping_lines_where(line, sale_ids):
+        """Returns the SQL condition selecting the lines to price of the
+        sales, shipping lines are not priced
+
+        :param line: The sale_line table
         """
-        Return pricelist shipping cost
+        SaleLine = Pool().get('sale.line')
+
+        shipment_cost = SaleLine.shipment_cost.sql_column(line)
+        return (
+            reduce_ids(line.sale, sale_ids)
+            & (line.product != None)  # noqa
+            & ((shipment_cost == None) | (shipment_cost == 0))  # noqa
+            & (line.quantity != None) & (line.quantity != 0)  # noqa
+        )
+
+    @classmethod
+    def _read_pricelist_shipping_rows(cls, sales):
+        """Read the lines to price of the stored sales with one SQL query
+        per slice of sales, without instantiating the lines.
+
+        :returns: A dictionary of sale id: list of tuple (product id,
+            quantity, unit id, count)
+        """
+        SaleLine = Pool().get('sale.line')
+        line = SaleLine.__table__()
+        cursor = Transaction().cursor
+
+        sale_ids = [sale.id for sale in sales]
+        result = dict((sale_id, []) for sale_id in sale_ids)
+        for i in range(0, len(sale_ids), cursor.IN_MAX):
+            sub_ids = sale_ids[i:i + cursor.IN_MAX]
+            cursor.execute(*line.select(
+                line.sale, line.product, line.quantity, line.unit,
+                Count(line.id),
+                where=cls._get_pricelist_shipping_lines_where(line, sub_ids),
+                group_by=(line.sale, line.product, line.quantity, line.unit)
+            ))
+            for row in cursor.fetchall():
+                result[row[0]].append(tuple(row[1:]))
+        return result
+
+    @classmethod
+    def get_pricelist_shipping_quantities(cls, sales):
+        """Return the quantities to price of the sales
+
+        The lines of the stored sales are read with a single query, see
+        :meth:`_read_pricelist_shipping_rows`, those of the sales which are
+        not stored are taken from the records.
+
+        :returns: A dictionary of sale id: dictionary of (product id,
+            quantity): line count
         """
-        Product = Pool().get('product.product')
         Carrier = Pool().get('carrier')
-        Company = Pool().get('company.company')
 
-        carrier, = Carrier.search([('carrier_cost_method', '=', 'pricelist')])
+        stored = [s for s in sales if s.id is not None and s.id >= 0]
+        result = {}
+        for sale_id, rows in \
+                cls._read_pricelist_shipping_rows(stored).iteritems():
+            result[sale_id] = Carrier.group_pricelist_quantities(rows)
+        for sale in sales:
+            if sale.id not in result:
+                result[sale.id] = sale._get_pricelist_shipping_quantities()
+        return result
+
+    @classmethod
+    def _sum_pricelist_materialized_costs(cls, carrier, currency, sales):
+        """Returns the costs of the stored sales computed from the
+        materialized rates of the carrier, see `carrier.pricelist.rate`
+
+        :returns: A dictionary of sale id: cost of the sales whose lines
+            all have a rate
+        """
+        Rate = Pool().get('carrier.pricelist.rate')
+        SaleLine = Pool().get('sale.line')
+        cursor = Transaction().cursor
+
+        if not Rate.materialized(carrier):
+            return {}
+
+        sale_ids = [s.id for s in sales if s.id is not None and s.id >= 0]
+        costs = {}
+        for i in range(0, len(sale_ids), cursor.IN_MAX):
+            sub_ids = sale_ids[i:i + cursor.IN_MAX]
+            line = SaleLine.__table__()
+            costs.update(Rate.sum_costs(carrier, currency, line.select(
+                line.sale.as_('document'), line.product, line.quantity,
+                line.unit,
+                where=cls._get_pricelist_shipping_lines_where(line, sub_ids)
+            )))
+        return costs
 
-        total = Decimal('0')
+    @classmethod
+    @instrument('sale.get_pricelist_shipping_costs')
+    def get_pricelist_shipping_costs(cls, sales):
+        """Return the pricelist shipping cost of many sales
+
+        The sales are grouped by (customer, price_list, currency). The costs
+        are summed from the materialized rates of the carrier when possible,
+        otherwise the products of each group are priced with a single call.
+        The zone of the shipment address of each sale is then applied.
+
+        :returns: A dictionary of sale id: (cost, currency_id)
+        """
+        if not Transaction().context.get('company'):
+            raise UserError("Company not in context.")
+
+        groups = defaultdict(list)
+        for sale in sales:
+            groups[(
+                sale.party.id, sale.carrier.price_list.id, sale.currency.id
+            )].append(sale)
+
+        costs = {}
+        for (_, _, currency), group in groups.iteritems():
+            materialized = cls._sum_pricelist_materialized_costs(
+                group[0].carrier, currency, group
+            )
+            for sale_id, cost in materialized.iteritems():
+                costs[sale_id] = (cost, currency)
+
+        quantities = cls.get_pricelist_shipping_quantities(
+            [sale for sale in sales if sale.id not in costs]
+        )
+        for (customer, price_list, currency), group in groups.iteritems():
+            group = [sale for sale in group if sale.id not in costs]
+            if not group:
+                continue
+            group_costs = group[0].carrier.get_pricelist_costs([
+                quantities[sale.id] for sale in group
+            ], customer, currency)
+            for sale, cost in zip(group, group_costs):
+                costs[sale.id] = (cost, currency)
+
+        for sale in sales:
+            cost, currency = costs[sale.id]
+            costs[sale.id] = (sale.carrier.apply_zone(
+                cost, currency, sale.shipment_address
+            ), currency)
+        return costs
+
+    @instrument('sale.get_pricelist_shipping_cost')
+    def get_pricelist_shipping_cost(self, carrier=None):
+        """
+        Return pricelist shipping cost
+
+        :param carrier: The carrier to compute the cost for, defaults to the
+            carrier of the sale
+        """
+        Carrier = Pool().get('carrier')
+        Company = Pool().get('company.company')
 
         company = Transaction().context.get('company')
         if not company:
@@ -90,48 +403,188 @@ class Sale:
 
         default_currency = Company(company).currency
 
+        carrier = Carrier.get_pricelist_carrier(carrier or self.carrier)
+
         try:
-            context = {
-                'customer': self.party.id,
-                'price_list': carrier.price_list.id,
-                'currency': self.currency.id,
-            }
-        except:
+            customer, currency = self.party.id, self.currency.id
+        except AttributeError:
             if Transaction().context.get('ignore_carrier_computation'):
                 # If carrier computation is ignored just return the
                 # default values
                 return Decimal('0'), default_currency.id
+            raise
 
-        with Transaction().set_context(**context):
-            for line in self.lines:
-                if not line.product:
-                    continue
-                total += \
-                    Product.get_sale_price([line.product])[line.product.id] * \
-                    Decimal(line.quantity)
-
-        return total, self.currency.id
+        materialized = self._sum_pricelist_materialized_costs(
+            carrier, currency, [self]
+        )
+        if self.id in materialized:
+            total = materialized[self.id]
+        else:
+            quantities = \
+                self.get_pricelist_shipping_quantities([self])[self.id]
+            total = carrier.get_pricelist_cost(quantities, customer, currency)
+        return carrier.apply_zone(
+            total, currency, self.shipment_address
+        ), currency
 
-    def get_pricelist_shipping_rates(self, silent=True):
+    def get_pricelist_shipping_rates(self, silent=True, carrier=None):
         """Get the shipping rates based on pricelist.
+
+        :param carrier: The carrier to get the rates for, defaults to the
+            carrier of the sale
         """
         Carrier = Pool().get('carrier')
 
-        carrier, = Carrier.search([('carrier_cost_method', '=', 'pricelist')])
+        carrier = Carrier.get_pricelist_carrier(carrier or self.carrier)
+
+        return self.get_all_pricelist_shipping_rates(carriers=[carrier])
+
+    @instrument('sale.get_all_pricelist_shipping_rates')
+    def get_all_pricelist_shipping_rates(self, carriers=None, workers=None):
+        """Get the shipping rates of many pricelist carriers at once.
+
+        The lines of the sale are read once for all the carriers.
+
+        :param carriers: The carriers to get the rates for, defaults to all
+            the carriers using the pricelist cost method
+        :param workers: The number of threads evaluating the price lists,
+            see `Carrier.get_pricelist_carriers_costs`
+        :returns: A list of tuple: (method, rate, currency, metadata,
+            write_vals)
+        """
+        Carrier = Pool().get('carrier')
+
+        if not Transaction().context.get('company'):
+            raise UserError("Company not in context.")
+
+        if carriers is None:
+            carriers = Carrier.get_pricelist_carriers()
+
+        quantities = self.get_pricelist_shipping_quantities([self])[self.id]
+        costs = Carrier.get_pricelist_carriers_costs(
+            carriers, quantities, self.party.id, self.currency.id,
+            workers=workers
+        )
+        for carrier in carriers:
+            costs[carrier.id] = carrier.apply_zone(
+                costs[carrier.id], self.currency.id, self.shipment_address
+            )
+
+        return Carrier.get_pricelist_rates(carriers, costs, self.currency.id)
+
+    @classmethod
+    def enqueue_pricelist_shipment_costs(cls, sales):
+        """Mark the shipping cost of the sales as pending so that the
+        shipping lines are computed by :meth:`process_pricelist_shipping_queue`
+
+        A sale already pending or requested many times is queued once.
+        """
+        to_mark = dict(
+            (sale.id, sale) for sale in sales
+            if sale.carrier
+            and sale.carrier.carrier_cost_method == 'pricelist'
+            and not sale.pricelist_shipping_pending
+        )
+        if to_mark:
+            cls.write(to_mark.values(), {'pricelist_shipping_pending': True})
+
+    @classmethod
+    def process_pricelist_shipping_queue(
+            cls, sales=None, batch_size=QUEUE_BATCH_SIZE):
+        """Compute the shipping lines of the sales whose shipping cost is
+        pending, by batches of sales of the same company
+
+        It is called by the cron of the deferred mode and can be called
+        directly to process the queue in the current transaction. The queue
+        is processed as root with the company of each batch in the context,
+        because the user of the cron has no company and the record rules
+        would hide every sale.
+
+        :param sales: The sales to process if they are pending, defaults to
+            all the pending sales in quotation
+        :param batch_size: The number of sales computed together
+        """
+        with Transaction().set_user(0):
+            if sales is None:
+                sales = cls.search([
+                    ('pricelist_shipping_pending', '=', True),
+                    ('state', '=', 'quotation'),
+                ])
+            else:
+                sales = cls.browse([
+                    s.id for s in sales if s.pricelist_shipping_pending
+                ])
+
+            by_company = defaultdict(list)
+            for sale in sales:
+                by_company[sale.company.id].append(sale.id)
+
+        for company, sale_ids in by_company.iteritems():
+            with Transaction().set_user(0), \
+                    Transaction().set_context(company=company):
+                for i in range(0, len(sale_ids), batch_size):
+                    batch = cls.browse(sale_ids[i:i + batch_size])
+                    cls.update_pricelist_shipment_costs(batch)
+                    cls.write(batch, {'pricelist_shipping_pending': False})
+                    counters.incr('sale.shipping_queue.processed', len(batch))
 
-        cost, currency_id = self.get_pricelist_shipping_cost()
+    @classmethod
+    def copy(cls, sales, default=None):
+        if default is None:
+            default = {}
+        default = default.copy()
+        default['pricelist_shipping_pending'] = False
+        return super(Sale, cls).copy(sales, default=default)
+
+    @classmethod
+    def draft(cls, sales):
+        res = super(Sale, cls).draft(sales)
+
+        pending = [s for s in sales if s.pricelist_shipping_pending]
+        if pending:
+            cls.write(pending, {'pricelist_shipping_pending': False})
+        return res
+
+    @classmethod
+    def cancel(cls, sales):
+        res = super(Sale, cls).cancel(sales)
 
-        return [(
-            carrier.party.name,
-            cost, currency_id, {}, {
-                'carrier_id': self.id
-            }
-        )]
+        pending = [s for s in sales if s.pricelist_shipping_pending]
+        if pending:
+            cls.write(pending, {'pricelist_shipping_pending': False})
+        return res
 
     @classmethod
     def quote(cls, sales):
         res = super(Sale, cls).quote(sales)
 
-        for sale in sales:
-            sale.update_pricelist_shipment_cost()
+        if cls._pricelist_shipping_deferred():
+            cls.enqueue_pricelist_shipment_costs(sales)
+        else:
+            cls.update_pricelist_shipment_costs(sales)
         return res
+
+    @classmethod
+    def confirm(cls, sales):
+        # The shipping lines of the sales still pending are computed before
+        # the sales are confirmed
+        cls.process_pricelist_shipping_queue(sales)
+
+        return super(Sale, cls).confirm(sales)
+
+    @classmethod
+    def process(cls, sales):
+        Shipment = Pool().get('stock.shipment.out')
+
+        existing = set(s.id for sale in sales for s in sale.shipments)
+        # The costs of the created shipments are computed together, after
+        # they are all created, instead of one shipment at a time
+        with Transaction().set_context(pricelist_shipping_batch=True):
+            super(Sale, cls).process(sales)
+
+        shipments = [
+            s for sale in cls.browse([s.id for s in sales])
+            for s in sale.shipments if s.id not in existing
+        ]
+        with Transaction().set_user(0, set_context=True):
+            Shipment.update_pricelist_shipment_costs(shipments)
@@ -5,12 +5,16 @@
     :copyright: (c) 2014 by Openlabs Technologies & Consulting (P) Limited
     :license: BSD, see LICENSE for more details.
 """
-from decimal import Decimal
+from collections import defaultdict
+
+from sql.aggregate import Count
 
 from trytond.transaction import Transaction
 from trytond.pool import PoolMeta, Pool
 from trytond.exceptions import UserError
 
+from stats import instrument
+
 __metaclass__ = PoolMeta
 __all__ = ['ShipmentOut']
 
@@ -23,38 +27,223 @@ class ShipmentOut:
         "Pass shipment in the context"
         context = super(ShipmentOut, self)._get_carrier_context()
 
-        if not self.carrier.carrier_cost_method == 'pricelist':
+        if self.carrier.carrier_cost_method not in ('pricelist', 'tier'):
             return context
 
         context = context.copy()
         context['shipment'] = self.id
         return context
 
-    def get_pricelist_shipping_cost(self):
+    def _get_pricelist_shipping_rows(self):
+        """Return the outgoing moves of the shipment record to price
+
+        :returns: A list of tuple: (product id, quantity, unit id, count)
         """
-        Return pricelist shipping cost
+        return [
+            (move.product.id, move.quantity, move.uom.id, 1)
+            for move in self.outgoing_moves
+        ]
+
+    @classmethod
+    def _read_pricelist_shipping_rows(cls, shipments):
+        """Read the outgoing moves of the shipments with one SQL query per
+        slice of shipments, without instantiating the moves.
+
+        :returns: A dictionary of shipment id: list of tuple (product id,
+            quantity, unit id, count)
+        """
+        Move = Pool().get('stock.move')
+        move = Move.__table__()
+        cursor = Transaction().cursor
+
+        # The outgoing moves leave the output location of the warehouse
+        outputs = dict(
+            ('%s,%s' % (cls.__name__, s.id), s.warehouse.output_location.id)
+            for s in shipments
+        )
+        result = dict((s.id, []) for s in shipments)
+        references = outputs.keys()
+        for i in range(0, len(references), cursor.IN_MAX):
+            sub_references = references[i:i + cursor.IN_MAX]
+            cursor.execute(*move.select(
+                move.shipment, move.from_location, move.product,
+                move.quantity, move.uom, Count(move.id),
+                where=move.shipment.in_(sub_references),
+                group_by=(
+                    move.shipment, move.from_location, move.product,
+                    move.quantity, move.uom,
+                )
+            ))
+            for row in cursor.fetchall():
+                reference, from_location = row[:2]
+                if from_location == outputs[reference]:
+                    shipment_id = int(reference.split(',')[1])
+                    result[shipment_id].append(tuple(row[2:]))
+        return result
+
+    @classmethod
+    def get_pricelist_shipping_quantities(cls, shipments):
+        """Return the quantities to price of the shipments
+
+        The moves of the stored shipments are read with a single query, see
+        :meth:`_read_pricelist_shipping_rows`, those of the shipments which
+        are not stored are taken from the records.
+
+        :returns: A dictionary of shipment id: dictionary of (product id,
+            quantity): move count
         """
-        Product = Pool().get('product.product')
         Carrier = Pool().get('carrier')
-        Company = Pool().get('company.company')
 
-        carrier, = Carrier.search([('carrier_cost_method', '=', 'pricelist')])
+        stored = [s for s in shipments if s.id is not None and s.id >= 0]
+        rows = cls._read_pricelist_shipping_rows(stored)
+        for shipment in shipments:
+            if shipment.id not in rows:
+                rows[shipment.id] = shipment._get_pricelist_shipping_rows()
+        return dict(
+            (shipment_id, Carrier.group_pricelist_quantities(shipment_rows))
+            for shipment_id, shipment_rows in rows.iteritems()
+        )
+
+    @classmethod
+    def _sum_pricelist_materialized_costs(cls, carrier, currency, shipments):
+        """Returns the costs of the stored shipments computed from the
+        materialized rates of the carrier, see `carrier.pricelist.rate`
+
+        :returns: A dictionary of shipment id: cost of the shipments whose
+            outgoing moves all have a rate
+        """
+        Rate = Pool().get('carrier.pricelist.rate')
+        Move = Pool().get('stock.move')
+        cursor = Transaction().cursor
+
+        if not Rate.materialized(carrier):
+            return {}
+
+        # The outgoing moves leave the output location of the warehouse
+        by_output = defaultdict(list)
+        for shipment in shipments:
+            if shipment.id is not None and shipment.id >= 0:
+                by_output[shipment.warehouse.output_location.id].append(
+                    '%s,%s' % (cls.__name__, shipment.id)
+                )
 
-        total = Decimal('0')
+        costs = {}
+        for output, references in by_output.iteritems():
+            for i in range(0, len(references), cursor.IN_MAX):
+                sub_references = references[i:i + cursor.IN_MAX]
+                move = Move.__table__()
+                totals = Rate.sum_costs(carrier, currency, move.select(
+                    move.shipment.as_('document'), move.product,
+                    move.quantity, move.uom.as_('unit'),
+                    where=move.shipment.in_(sub_references)
+                    & (move.from_location == output)
+                ))
+                for reference, cost in totals.iteritems():
+                    costs[int(reference.split(',')[1])] = cost
+        return costs
+
+    @classmethod
+    @instrument('stock.shipment.out.get_pricelist_shipping_costs')
+    def get_pricelist_shipping_costs(cls, shipments, carrier=None):
+        """Return the pricelist shipping cost of many shipments
+
+        The shipments are grouped by (customer, price_list). The costs are
+        summed from the materialized rates of the carrier when possible,
+        otherwise the moves of the stored shipments are read with a single
+        query and the products of each group are priced with a single call.
+        The zone of the delivery address of each shipment is then applied.
+
+        :param carrier: The carrier to compute the costs for, defaults to
+            the carrier of each shipment
+        :returns: A dictionary of shipment id: (cost, currency_id)
+        """
+        Carrier = Pool().get('carrier')
+        Company = Pool().get('company.company')
 
         company = Transaction().context.get('company')
         if not company:
             raise UserError("Company not in context.")
 
-        default_currency = Company(company).currency
+        currency = Company(company).currency.id
+
+        groups = defaultdict(list)
+        for shipment in shipments:
+            shipment_carrier = Carrier.get_pricelist_carrier(
+                carrier or shipment.carrier
+            )
+            groups[(
+                shipment.customer.id, shipment_carrier.price_list.id
+            )].append((shipment, shipment_carrier))
+
+        costs = {}
+        for group in groups.itervalues():
+            materialized = cls._sum_pricelist_materialized_costs(
+                group[0][1], currency, [shipment for shipment, _ in group]
+            )
+            for shipment_id, cost in materialized.iteritems():
+                costs[shipment_id] = (cost, currency)
+        quantities = cls.get_pricelist_shipping_quantities(
+            [s for s in shipments if s.id not in costs]
+        )
+        for (customer, _), group in groups.iteritems():
+            group = [(s, c) for s, c in group if s.id not in costs]
+            if not group:
+                continue
+            group_costs = group[0][1].get_pricelist_costs([
+                quantities[shipment.id] for shipment, _ in group
+            ], customer, currency)
+            for (shipment, _), cost in zip(group, group_costs):
+                costs[shipment.id] = (cost, currency)
+
+        for group in groups.itervalues():
+            for shipment, shipment_carrier in group:
+                costs[shipment.id] = (shipment_carrier.apply_zone(
+                    costs[shipment.id][0], currency, shipment.delivery_address
+                ), currency)
+        return costs
+
+    @instrument('stock.shipment.out.get_pricelist_shipping_cost')
+    def get_pricelist_shipping_cost(self, carrier=None):
+        """
+        Return pricelist shipping cost
+
+        :param carrier: The carrier to compute the cost for, defaults to the
+            carrier of the shipment
+        """
+        return self.get_pricelist_shipping_costs(
+            [self], carrier=carrier
+        )[self.id]
+
+    @classmethod
+    def update_pricelist_shipment_costs(cls, shipments):
+        """Set the cost of the shipments using the pricelist cost method
+
+        The costs of all the shipments are computed with
+        :meth:`get_pricelist_shipping_costs` and written with a single call.
+        It is called for the shipments created by the processing of the
+        sales.
+        """
+        Currency = Pool().get('currency.currency')
 
-        with Transaction().set_context(
-                customer=self.customer.id,
-                price_list=carrier.price_list.id,
-                currency=default_currency.id):
-            for move in self.outgoing_moves:
-                total += \
-                    Product.get_sale_price([move.product])[move.product.id] * \
-                    Decimal(move.quantity)
+        shipments = [
+            s for s in shipments
+            if s.carrier and s.carrier.carrier_cost_method == 'pricelist'
+        ]
+        if not shipments:
+            return
 
-        return total, default_currency.id
+        to_write = []
+        costs = cls.get_pricelist_shipping_costs(shipments)
+        for shipment in shipments:
+            cost, currency_id = costs[shipment.id]
+            cost = Currency(currency_id).round(cost)
+            cost_currency = shipment.cost_currency
+            if shipment.cost == cost and cost_currency \
+                    and cost_currency.id == currency_id:
+                continue
+            to_write.extend(([shipment], {
+                'cost': cost,
+                'cost_currency': currency_id,
+            }))
+        if to_write:
+            cls.write(*to_write)
@@ -0,0 +1,199 @@
+# -*- coding: utf-8 -*-
+"""
+    stats.py
+
+    :copyright: (c) 2014 by Openlabs Technologies & Consulting (P) Limited
+    :license: BSD, see LICENSE for more details.
+"""
+import time
+import logging
+from functools import wraps
+from collections import defaultdict
+from threading import Lock, local
+
+from trytond.config import CONFIG
+from trytond.transaction import Transaction
+
+__all__ = [
+    'Counters', 'counters', 'Registry', 'registry', 'enabled', 'measure',
+    'instrument', 'note',
+]
+
+logger = logging.getLogger('carrier_pricelist')
+
+# Per thread stack of the running measures and cache hits and misses
+_local = local()
+
+
+class Counters(object):
+    """
+    Named counters shared by the transactions of the process.
+    """
+
+    def __init__(self):
+        self._counts = defaultdict(int)
+        self._lock = Lock()
+
+    def incr(self, name, value=1):
+        with self._lock:
+            self._counts[name] += value
+
+    def get(self, name):
+        with self._lock:
+            return self._counts[name]
+
+    def items(self):
+        with self._lock:
+            return dict(self._counts)
+
+    def reset(self):
+        with self._lock:
+            self._counts.clear()
+
+
+counters = Counters()
+
+
+class Registry(object):
+    """
+    Aggregated measures of the instrumented calls of the process.
+    """
+    fields = (
+        'duration', 'lines', 'products', 'queries', 'cache_hits',
+        'cache_misses',
+    )
+
+    def __init__(self):
+        self._stats = {}
+        self._lock = Lock()
+
+    def add(self, name, values):
+        with self._lock:
+            stats = self._stats.get(name)
+            if stats is None:
+                stats = self._stats[name] = dict.fromkeys(self.fields, 0)
+                stats['calls'] = 0
+                stats['max_duration'] = 0
+            stats['calls'] += 1
+            stats['max_duration'] = max(
+                stats['max_duration'], values['duration']
+            )
+            for field in self.fields:
+                stats[field] += values[field]
+
+    def get(self):
+        "Returns a dictionary of name: aggregated measures"
+        with self._lock:
+            return dict((k, dict(v)) for k, v in self._stats.iteritems())
+
+    def reset(self):
+        with self._lock:
+            self._stats.clear()
+
+
+registry = Registry()
+
+
+def enabled():
+    "The instrumentation is enabled with carrier_pricelist_stats = True"
+    return bool(CONFIG.get('carrier_pricelist_stats'))
+
+
+def cache_hit(hit):
+    "Count a cache hit or miss of the current thread"
+    name = 'cache_hits' if hit else 'cache_misses'
+    setattr(_local, name, getattr(_local, name, 0) + 1)
+
+
+def note(name, value):
+    """Add the value to the running measures, name is either 'lines' for
+    the number of lines or moves priced or 'products' for the number of
+    products priced
+    """
+    for current in getattr(_local, 'measures', ()):
+        current.values[name] = current.values.get(name, 0) + value
+
+
+def _count_queries(cursor):
+    "Count the queries executed by the cursor"
+    if getattr(cursor, '_carrier_pricelist_queries', None) is None:
+        execute = cursor.execute
+
+        def counting_execute(*args, **kwargs):
+            cursor._carrier_pricelist_queries += 1
+            return execute(*args, **kwargs)
+        cursor._carrier_pricelist_queries = 0
+        cursor.execute = counting_execute
+    return cursor._carrier_pricelist_queries
+
+
+class _Measure(object):
+    "Measure the duration, queries and cache usage of a block"
+
+    def __init__(self, name):
+        self.name = name
+        self.values = {}
+
+    def _snapshot(self):
+        return (
+            time.time(), _count_queries(Transaction().cursor),
+            getattr(_local, 'cache_hits', 0),
+            getattr(_local, 'cache_misses', 0),
+        )
+
+    def __enter__(self):
+        self._start = self._snapshot()
+        _local.__dict__.setdefault('measures', []).append(self)
+        return self
+
+    def __exit__(self, type, value, traceback):
+        _local.measures.remove(self)
+        end = self._snapshot()
+        values = {
+            'duration': end[0] - self._start[0],
+            'queries': end[1] - self._start[1],
+            'cache_hits': end[2] - self._start[2],
+            'cache_misses': end[3] - self._start[3],
+            'lines': self.values.get('lines', 0),
+            'products': self.values.get('products', 0),
+        }
+        registry.add(self.name, values)
+        logger.info(
+            '%s duration=%.6f lines=%d products=%d queries=%d '
+            'cache_hits=%d cache_misses=%d', self.name, values['duration'],
+            values['lines'], values['products'], values['queries'],
+            values['cache_hits'], values['cache_misses'],
+            extra={'carrier_pricelist': dict(values, name=self.name)}
+        )
+
+
+class _NoMeasure(object):
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, type, value, traceback):
+        pass
+
+
+_no_measure = _NoMeasure()
+
+
+def measure(name):
+    "Returns a context manager measuring the block when enabled"
+    if not enabled():
+        return _no_measure
+    return _Measure(name)
+
+
+def instrument(name):
+    "Decorator measuring the calls of the function when enabled"
+    def decorator(func):
+        @wraps(func)
+        def wrapper(*args, **kwargs):
+            if not enabled():
+                return func(*args, **kwargs)
+            with _Measure(name):
+                return func(*args, **kwargs)
+        return wrapper
+    return decorator
@@ -0,0 +1,275 @@
+# -*- coding: utf-8 -*-
+"""
+    tests/benchmark.py
+
+    Benchmarks the pricelist shipping computations on synthetic datasets
+    built in the sqlite in-memory test database. Run it with::
+
+        python tests/benchmark.py --lines 10 100 1000 --output results.json
+
+    See ``python tests/benchmark.py --help`` for the dataset parameters.
+
+    The results are reported as JSON with the wall time, the number of SQL
+    queries and the growth of the resident memory of the process during the
+    runs of each benchmark.
+
+    :copyright: (C) 2014 by Openlabs Technologies & Consulting (P) Limited
+    :license: BSD, see LICENSE for more details.
+"""
+import sys
+import os
+DIR = os.path.abspath(os.path.normpath(os.path.join(
+    __file__, '..', '..', '..', '..', '..', 'trytond'
+)))
+if os.path.isdir(DIR):
+    sys.path.insert(0, os.path.dirname(DIR))
+sys.path.insert(
+    0, os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+)
+import json
+import time
+import argparse
+import ConfigParser
+from decimal import Decimal
+if 'DB_NAME' not in os.environ:
+    from trytond.config import CONFIG
+    CONFIG['db_type'] = 'sqlite'
+    os.environ['DB_NAME'] = ':memory:'
+
+from trytond.version import VERSION
+from trytond.tests.test_tryton import POOL, USER, DB_NAME, CONTEXT
+from trytond.transaction import Transaction
+
+from tests.test_carrier import CarrierTestCase
+
+PRODUCTS = 50
+PRICE_LIST_LINES = 20
+LINES = (10, 100, 1000)
+SALES = 20
+REPEAT = 3
+PAGE_SIZE_KB = os.sysconf('SC_PAGE_SIZE') // 1024
+
+
+def rss_kb():
+    "Returns the resident memory of the process in kilobytes or None"
+    try:
+        with open('/proc/self/statm') as statm:
+            return int(statm.read().split()[1]) * PAGE_SIZE_KB
+    except IOError:
+        return None
+
+
+def measure(func, repeat=REPEAT, setup=None):
+    """Run the function and measure the best run
+
+    :param func: The function to benchmark
+    :param repeat: The number of runs
+    :param setup: A function called before each run, not measured
+    :returns: A dictionary with the wall time in seconds and the number of
+        SQL queries of the fastest run, and the largest growth in kilobytes
+        of the resident memory over a run, None when it can not be read
+    """
+    cursor = Transaction().cursor
+    execute = cursor.execute
+    queries = [0]
+
+    def counting_execute(*args, **kwargs):
+        queries[0] += 1
+        return execute(*args, **kwargs)
+
+    best, rss_growth = None, None
+    cursor.execute = counting_execute
+    try:
+        for _ in xrange(repeat):
+            if setup is not None:
+                setup()
+            queries[0] = 0
+            rss = rss_kb()
+            start = time.time()
+            func()
+            wall_time = time.time() - start
+            if rss is not None:
+                rss_growth = max(rss_growth, rss_kb() - rss)
+            if best is None or wall_time < best['wall_time']:
+                best = {'wall_time': wall_time, 'queries': queries[0]}
+    finally:
+        cursor.execute = execute
+    best['rss_growth_kb'] = rss_growth
+    return best
+
+
+class Dataset(object):
+    """
+    Products, carrier price list and documents of a benchmark
+    """
+
+    def __init__(
+            self, case, products=PRODUCTS, price_list_lines=PRICE_LIST_LINES):
+        self.case = case
+        # The flat rate depends on the context so that the price list is
+        # neither constant nor materialized and its formulas are evaluated
+        case._use_general_price_list()
+        self.products = self._create_products(products)
+        self._create_price_list_lines(price_list_lines)
+        self.pricelist_kind = case.Carrier(case.carrier.id).pricelist_kind
+
+    def _create_products(self, count):
+        case = self.case
+        unit, = case.Uom.search([('name', '=', 'Unit')])
+        account_revenue = case._get_account_by_kind('revenue').id
+        templates = case.ProductTemplate.create([{
+            'name': 'Benchmark Product %d' % index,
+            'type': 'goods',
+            'salable': True,
+            'default_uom': unit.id,
+            'sale_uom': unit.id,
+            'list_price': Decimal(10 + index),
+            'cost_price': Decimal(5 + index),
+            'account_revenue': account_revenue,
+            'products': [('create', [{'code': 'bench-%d' % index}])],
+        } for index in xrange(count)])
+        return [template.products[0] for template in templates]
+
+    def _create_price_list_lines(self, count):
+        "Add product specific formula lines before the flat rate line"
+        PriceListLine = POOL.get('product.price_list.line')
+
+        PriceListLine.create([{
+            'price_list': self.case.carrier.price_list.id,
+            'sequence': index,
+            'product': self.products[index % len(self.products)].id,
+            'quantity': float(index % 5),
+            'formula': 'unit_price * 0.01 + %d.5' % (index % 7),
+        } for index in xrange(count)])
+
+    def create_sale(self, lines):
+        return self.case._create_sale(lines, products=self.products)
+
+    def create_shipment(self, lines):
+        case = self.case
+        sale = self.create_sale(lines)
+        case.Sale.quote([sale])
+        case.Sale.confirm([sale])
+        case.Sale.process([sale])
+        shipment, = case.Sale(sale.id).shipments
+        return shipment
+
+
+def clear_caches():
+    Carrier = POOL.get('carrier')
+    Carrier.clear_pricelist_caches()
+
+
+def run(products=PRODUCTS, price_list_lines=PRICE_LIST_LINES, lines=LINES,
+        sales=SALES, repeat=REPEAT):
+    """Build the dataset and run the benchmarks
+
+    :returns: A dictionary ready to be dumped as JSON
+    """
+    case = CarrierTestCase('test_0010_test_shipping_price')
+    case.setUp()
+
+    Shipment = POOL.get('stock.shipment.out')
+
+    results = []
+    with Transaction().start(DB_NAME, USER, context=CONTEXT):
+        case.setup_defaults()
+        dataset = Dataset(case, products, price_list_lines)
+        pricelist_kind = dataset.pricelist_kind
+
+        def add(name, size, result):
+            result.update({'name': name, 'lines': size})
+            results.append(result)
+
+        with Transaction().set_context(company=case.company.id):
+            for size in lines:
+                sale = dataset.create_sale(size)
+
+                add('sale.get_pricelist_shipping_cost.per_line', size, measure(
+                    lambda: case._get_per_line_shipping_cost(
+                        case.Sale(sale.id)
+                    ), repeat, clear_caches
+                ))
+                add('sale.get_pricelist_shipping_cost', size, measure(
+                    lambda: case.Sale(sale.id).get_pricelist_shipping_cost(),
+                    repeat, clear_caches
+                ))
+                with Transaction().set_context(sale=sale.id):
+                    add('carrier.get_rates', size, measure(
+                        lambda: case.Carrier(case.carrier.id).get_rates(),
+                        repeat, clear_caches
+                    ))
+
+                shipment = dataset.create_shipment(size)
+                add('stock.shipment.out.get_pricelist_shipping_cost', size,
+                    measure(
+                        lambda: Shipment(
+                            shipment.id
+                        ).get_pricelist_shipping_cost(),
+                        repeat, clear_caches
+                    ))
+
+                batch = []
+
+                def create_sales():
+                    # Each run creates the shipping lines of new sales
+                    batch[:] = [
+                        dataset.create_sale(size) for _ in xrange(sales)
+                    ]
+                    clear_caches()
+                add('sale.quote[%d]' % sales, size, measure(
+                    lambda: case.Sale.quote(batch), repeat, create_sales
+                ))
+
+        Transaction().cursor.rollback()
+
+    config = ConfigParser.ConfigParser()
+    config.read(os.path.join(
+        os.path.dirname(os.path.dirname(os.path.abspath(__file__))),
+        'tryton.cfg'
+    ))
+    return {
+        'versions': {
+            'carrier_pricelist': config.get('tryton', 'version'),
+            'trytond': VERSION,
+        },
+        'parameters': {
+            'products': products,
+            'price_list_lines': price_list_lines,
+            'lines': list(lines),
+            'sales': sales,
+            'repeat': repeat,
+            'pricelist_kind': pricelist_kind,
+        },
+        'results': results,
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description='Benchmark the pricelist shipping computations'
+    )
+    parser.add_argument('--products', type=int, default=PRODUCTS)
+    parser.add_argument(
+        '--price-list-lines', type=int, default=PRICE_LIST_LINES
+    )
+    parser.add_argument('--lines', type=int, nargs='+', default=LINES)
+    parser.add_argument('--sales', type=int, default=SALES)
+    parser.add_argument('--repeat', type=int, default=REPEAT)
+    parser.add_argument('--output', help='The JSON file, stdout by default')
+    options = parser.parse_args()
+
+    report = run(
+        options.products, options.price_list_lines, options.lines,
+        options.sales, options.repeat
+    )
+    output = json.dumps(report, indent=2, sort_keys=True)
+    if options.output:
+        with open(options.output, 'w') as fp:
+            fp.write(output)
+    else:
+        print(output)
+
+
+if __name__ == '__main__':
+    main()
@@ -14,6 +14,8 @@ if os.path.isdir(DIR):
     sys.path.insert(0, os.path.dirname(DIR))
 import unittest
 import datetime
+import time
+import threading
 from decimal import Decimal
 from dateutil.relativedelta import relativedelta
 if 'DB_NAME' not in os.environ:
@@ -25,7 +27,13 @@ import pycountry
 
 import trytond.tests.test_tryton
 from trytond.tests.test_tryton import POOL, USER, DB_NAME, CONTEXT
+from trytond.config import CONFIG
 from trytond.transaction import Transaction
+from trytond import backend
+from trytond.exceptions import UserError
+
+from trytond.modules.carrier_pricelist.stats import counters
+from trytond.modules.carrier_pricelist import vectorize
 
 
 class CarrierTestCase(unittest.TestCase):
@@ -299,6 +307,118 @@ class CarrierTestCase(unittest.TestCase):
             }])]
         }])
 
+    def _delete_defaults(self, sale_ids):
+        """Deletes the sales and the data created by :meth:`setup_defaults`,
+        for the tests which commit them
+        """
+        Account = POOL.get('account.account')
+        AccountType = POOL.get('account.account.type')
+        FiscalYear = POOL.get('account.fiscalyear')
+        PaymentTerm = POOL.get('account.invoice.payment_term')
+        PriceList = POOL.get('product.price_list')
+        Property = POOL.get('ir.property')
+        Sequence = POOL.get('ir.sequence')
+        SequenceStrict = POOL.get('ir.sequence.strict')
+
+        company = self.Company(self.company.id)
+        carrier = self.Carrier(self.carrier.id)
+        domain = [('company', '=', company.id)]
+        template_ids = [
+            self.template1.id, self.template2.id,
+            carrier.carrier_product.template.id,
+        ]
+        party_ids = [
+            company.party.id, self.Employee(self.employee.id).party.id,
+            carrier.party.id, self.sale_party.id,
+        ]
+
+        self.Sale.delete(self.Sale.browse(sale_ids))
+        self.Carrier.delete([carrier])
+        PriceList.delete(PriceList.search(domain))
+        self.ProductTemplate.delete(self.ProductTemplate.browse(template_ids))
+        PaymentTerm.delete(PaymentTerm.browse([self.payment_term.id]))
+        Property.delete(Property.search(domain))
+        FiscalYear.delete(FiscalYear.search(domain))
+        Sequence.delete(Sequence.search(domain))
+        SequenceStrict.delete(SequenceStrict.search(domain))
+        for Model in [Account, AccountType]:
+            # The children before their parent
+            records = Model.search(domain)
+            while records:
+                Model.delete([r for r in records if not r.childs])
+                records = Model.search(domain)
+
+        self.User.write([self.User(USER)], {
+            'employee': None,
+            'employees': [('remove', [self.employee.id])],
+            'main_company': None,
+            'company': None,
+        })
+        self.Employee.delete([self.Employee(self.employee.id)])
+        self.Company.delete([company])
+        Property.delete(Property.search([
+            ('res', 'in', ['party.party,%s' % i for i in party_ids]),
+        ]))
+        self.Party.delete(self.Party.browse(party_ids))
+        self.Currency.delete([self.Currency(self.currency.id)])
+
+    def _create_sale(self, line_count, quantity=2, products=None):
+        """Creates a draft sale with the given number of lines alternating
+        between the products, the two test products by default
+        """
+        if products is None:
+            products = [self.product1, self.product2]
+        lines = []
+        for index in xrange(line_count):
+            product = products[index % len(products)]
+            lines.append({
+                'type': 'line',
+                'quantity': quantity + index % 3,
+                'product': product,
+                'unit_price': product.list_price,
+                'description': 'Line %d' % index,
+                'unit': product.template.default_uom,
+            })
+        sale, = self.Sale.create([{
+            'company': self.company,
+            'currency': self.currency,
+            'payment_term': self.payment_term,
+            'party': self.sale_party.id,
+            'invoice_address': self.sale_party.addresses[0].id,
+            'shipment_address': self.sale_party.addresses[0].id,
+            'carrier': self.carrier.id,
+            'lines': [('create', lines)],
+        }])
+        return sale
+
+    def _use_general_price_list(self, rate='5.0'):
+        """Make the flat rate of the carrier price list depend on the
+        context, so that the products are priced by the price list
+        """
+        PriceListLine = POOL.get('product.price_list.line')
+
+        line, = self.carrier.price_list.lines
+        PriceListLine.write([line], {
+            'formula': '%s if locals() else unit_price' % rate,
+        })
+
+    def _get_per_line_shipping_cost(self, sale):
+        """Reference implementation pricing each sale line on its own
+        """
+        total = Decimal('0')
+        with Transaction().set_context(
+                customer=sale.party.id,
+                price_list=self.carrier.price_list.id,
+                currency=sale.currency.id):
+            for line in sale.lines:
+                if not line.product:
+                    continue
+                total += \
+                    self.Product.get_sale_price([line.product])[
+                        line.product.id
+                    ] * Decimal(line.quantity)
+        return total
+
     def test_0010_test_shipping_price(self):
         """Test shipping price
         """
@@ -351,6 +471,1382 @@ class CarrierTestCase(unittest.TestCase):
             shipment, = sale.shipments
             self.assertEqual(shipment.cost, Decimal(20))
 
+    def test_0020_batched_shipping_cost_matches_per_line(self):
+        """Batched shipping cost equals the per line computation
+        """
+        with Transaction().start(DB_NAME, USER, context=CONTEXT):
+            self.setup_defaults()
+
+            sale = self._create_sale(25)
+
+            with Transaction().set_context(company=self.company.id):
+                cost, currency_id = sale.get_pricelist_shipping_cost()
+
+            self.assertEqual(currency_id, self.currency.id)
+            self.assertEqual(
+                cost.quantize(Decimal('0.01')),
+                self._get_per_line_shipping_cost(sale).quantize(
+                    Decimal('0.01')
+                )
+            )
+            # 25 lines with quantities 2, 3 and 4 at a flat 5 per unit
+            self.assertEqual(cost, Decimal('370'))
+
+    def test_0030_shipment_shipping_cost(self):
+        """Shipment cost prices moves sharing a product only once
+        """
+        with Transaction().start(DB_NAME, USER, context=CONTEXT):
+            self.setup_defaults()
+
+            sale = self._create_sale(10)
+
+            with Transaction().set_context(company=self.company.id):
+                self.Sale.quote([sale])
+                self.Sale.confirm([sale])
+                self.Sale.process([sale])
+
+                shipment, = sale.shipments
+                self.assertEqual(len(shipment.outgoing_moves), 10)
+                # 10 lines with quantities 2, 3 and 4 at a flat 5 per unit
+                self.assertEqual(
+                    shipment.get_pricelist_shipping_cost(),
+                    (Decimal('145'), self.currency.id)
+                )
+
+    def test_0040_quote_many_sales(self):
+        """Quoting many sales adds exactly one shipping line to each
+        """
+        with Transaction().start(DB_NAME, USER, context=CONTEXT):
+            self.setup_defaults()
+
+            sales = [self._create_sale(2), self._create_sale(3)]
+
+            with Transaction().set_context(company=self.company.id):
+                self.Sale.quote(sales)
+                # Quoting again replaces the existing shipping lines
+                self.Sale.draft(sales)
+                self.Sale.quote(sales)
+
+            sale1, sale2 = self.Sale.browse(map(int, sales))
+            self.assertEqual(len(sale1.lines), 3)
+            self.assertEqual(len(sale2.lines), 4)
+
+            shipping_line1, = [l for l in sale1.lines if l.shipment_cost]
+            shipping_line2, = [l for l in sale2.lines if l.shipment_cost]
+            self.assertEqual(shipping_line1.amount, Decimal('25'))
+            self.assertEqual(shipping_line2.amount, Decimal('45'))
+
+    def test_0050_multiple_pricelist_carriers(self):
+        """Costs and rates use the carrier they are computed for
+        """
+        with Transaction().start(DB_NAME, USER, context=CONTEXT):
+            self.setup_defaults()
+
+            express_price_list, = self.PriceList.create([{
+                'name': 'Express',
+                'company': self.company.id,
+                'lines': [('create', [{'formula': '10.0'}])],
+            }])
+            express, = self.Carrier.copy([self.carrier], {
+                'price_list': express_price_list.id,
+            })
+
+            sale = self._create_sale(2)
+
+            with Transaction().set_context(
+                    company=self.company.id, sale=sale.id):
+                self.assertEqual(
+                    self.carrier.get_sale_price(),
+                    (Decimal('25'), self.currency.id)
+                )
+                self.assertEqual(
+                    express.get_sale_price(),
+                    (Decimal('50'), self.currency.id)
+                )
+
+                (_, cost, _, _, values), = express.get_rates()
+                self.assertEqual(cost, Decimal('50'))
+                self.assertEqual(values['carrier_id'], express.id)
+
+                # The cached lookup follows the writes on carriers
+                self.assertEqual(
+                    self.Carrier.get_pricelist_carrier(), self.carrier
+                )
+                self.Carrier.write([self.carrier], {
+                    'carrier_cost_method': 'product',
+                })
+                self.assertEqual(self.Carrier.get_pricelist_carrier(), express)
+
+    def test_0060_pricelist_prices_cache(self):
+        """Prices are cached for the transaction until the price list changes
+        """
+        with Transaction().start(DB_NAME, USER, context=CONTEXT):
+            self.setup_defaults()
+            self._use_general_price_list()
+
+            sale = self._create_sale(4)
+            cache = self.Carrier._pricelist_prices_cache
+            cache.reset_stats()
+
+            with Transaction().set_context(company=self.company.id):
+                self.assertEqual(
+                    sale.get_pricelist_shipping_cost()[0], Decimal('55')
+                )
+                self.assertEqual(cache.stats()['misses'], 2)
+                self.assertEqual(cache.stats()['hits'], 0)
+
+                (_, cost, _, _, _), = sale.get_pricelist_shipping_rates()
+                self.assertEqual(cost, Decimal('55'))
+                self.assertEqual(cache.stats()['misses'], 2)
+                self.assertEqual(cache.stats()['hits'], 2)
+
+                self._use_general_price_list('10.0')
+                self.assertEqual(
+                    sale.get_pricelist_shipping_cost()[0], Decimal('110')
+                )
+                self.assertEqual(cache.stats()['misses'], 4)
+
+    def test_0070_shared_costs_cache(self):
+        """Costs are shared across transactions until the products change
+        """
+        with Transaction().start(DB_NAME, USER, context=CONTEXT):
+            self.setup_defaults()
+            self._use_general_price_list()
+
+            sale = self._create_sale(4)
+            prices_cache = self.Carrier._pricelist_prices_cache
+
+            CONFIG['carrier_pricelist_cache'] = True
+            try:
+                with Transaction().set_context(company=self.company.id):
+                    self.assertEqual(
+                        sale.get_pricelist_shipping_cost()[0], Decimal('55')
+                    )
+
+                    # The cost is served without pricing the products
+                    prices_cache.clear()
+                    prices_cache.reset_stats()
+                    self.assertEqual(
+                        sale.get_pricelist_shipping_cost()[0], Decimal('55')
+                    )
+                    self.assertEqual(prices_cache.stats()['misses'], 0)
+
+                    # Writing a product clears the costs
+                    self.Product.write([self.product1], {'code': 'P1'})
+                    self.assertEqual(
+                        sale.get_pricelist_shipping_cost()[0], Decimal('55')
+                    )
+                    self.assertEqual(prices_cache.stats()['misses'], 2)
+
+                    # Expired costs are computed again
+                    CONFIG['carrier_pricelist_cache_ttl'] = '0.000001'
+                    prices_cache.clear()
+                    time.sleep(0.01)
+                    self.assertEqual(
+                        sale.get_pricelist_shipping_cost()[0], Decimal('55')
+                    )
+                    self.assertEqual(prices_cache.stats()['misses'], 4)
+            finally:
+                CONFIG['carrier_pricelist_cache'] = False
+                CONFIG['carrier_pricelist_cache_ttl'] = None
+
+    def test_0080_requote_keeps_shipping_line(self):
+        """Quoting again only rewrites the shipping line when the cost changed
+        """
+        SaleLine = POOL.get('sale.line')
+
+        with Transaction().start(DB_NAME, USER, context=CONTEXT):
+            self.setup_defaults()
+
+            sale = self._create_sale(2)
+            counters.reset()
+
+            with Transaction().set_context(company=self.company.id):
+                self.Sale.quote([sale])
+                shipping_line, = [l for l in sale.lines if l.shipment_cost]
+
+                self.Sale.draft([sale])
+                self.Sale.quote([sale])
+                self.assertEqual(
+                    counters.get('sale.shipping_line.skipped'), 1
+                )
+
+                self.Sale.draft([sale])
+                line = [l for l in sale.lines if not l.shipment_cost][0]
+                SaleLine.write([line], {'quantity': 10})
+                self.Sale.quote([sale])
+                self.assertEqual(
+                    counters.get('sale.shipping_line.skipped'), 1
+                )
+
+            sale = self.Sale(sale.id)
+            line, = [l for l in sale.lines if l.shipment_cost]
+            self.assertEqual(line.id, shipping_line.id)
+            self.assertEqual(line.amount, Decimal('65'))
+
+    def test_0090_on_change_lines_estimate(self):
+        """The shipping cost is estimated incrementally on line changes
+        """
+        SaleLine = POOL.get('sale.line')
+
+        with Transaction().start(DB_NAME, USER, context=CONTEXT):
+            self.setup_defaults()
+            self._use_general_price_list()
+
+            unit = self.product1.template.default_uom
+            line1 = SaleLine(
+                type='line', product=self.product1, quantity=2, unit=unit
+            )
+            line2 = SaleLine(
+                type='line', product=self.product2, quantity=3, unit=unit
+            )
+            sale = self.Sale(
+                party=self.sale_party, currency=self.currency,
+                carrier=self.carrier, lines=[line1],
+            )
+            prices_cache = self.Carrier._pricelist_prices_cache
+            prices_cache.reset_stats()
+
+            with Transaction().set_context(company=self.company.id):
+                self.assertEqual(
+                    sale.get_pricelist_shipping_estimate(),
+                    (Decimal('10'), self.currency.id)
+                )
+
+                # Only the product of the added line is priced
+                sale.lines = [line1, line2]
+                self.assertEqual(
+                    sale.get_pricelist_shipping_estimate()[0], Decimal('25')
+                )
+                self.assertEqual(prices_cache.stats()['misses'], 2)
+
+                line1.quantity = 4
+                self.assertEqual(
+                    sale.get_pricelist_shipping_estimate()[0], Decimal('35')
+                )
+                self.assertEqual(prices_cache.stats()['misses'], 2)
+
+                sale.lines = [line1]
+                result = sale.on_change_lines()
+
+            (_, shipping_line), = result['lines']['add']
+            self.assertEqual(shipping_line['amount'], Decimal('20'))
+
+    def test_0100_rates_of_all_pricelist_carriers(self):
+        """Rates of all the pricelist carriers are computed in one call
+        """
+        with Transaction().start(DB_NAME, USER, context=CONTEXT):
+            self.setup_defaults()
+
+            express_price_list, = self.PriceList.create([{
+                'name': 'Express',
+                'company': self.company.id,
+                'lines': [('create', [{'formula': '10.0'}])],
+            }])
+            express, = self.Carrier.copy([self.carrier], {
+                'price_list': express_price_list.id,
+            })
+            freight, = self.Carrier.copy([self.carrier])
+
+            sale = self._create_sale(2)
+
+            with Transaction().set_context(company=self.company.id):
+                rates = sale.get_all_pricelist_shipping_rates()
+
+            self.assertEqual(
+                [(rate[1], rate[2], rate[4]['carrier_id']) for rate in rates],
+                [
+                    (Decimal('25'), self.currency.id, self.carrier.id),
+                    (Decimal('50'), self.currency.id, express.id),
+                    (Decimal('25'), self.currency.id, freight.id),
+                ]
+            )
+
+    def test_0110_pricelist_stats(self):
+        """Pricelist computations are measured when enabled
+        """
+        with Transaction().start(DB_NAME, USER, context=CONTEXT):
+            self.setup_defaults()
+            self._use_general_price_list()
+
+            sale = self._create_sale(4)
+            self.Carrier.reset_pricelist_stats()
+
+            # The measures of the process are reset by administrators only
+            user, = self.User.create([{
+                'name': 'Salesman',
+                'login': 'salesman',
+            }])
+            with Transaction().set_user(user.id):
+                self.assertRaises(
+                    UserError, self.Carrier.reset_pricelist_stats
+                )
+
+            with Transaction().set_context(company=self.company.id):
+                sale.get_pricelist_shipping_cost()
+                self.assertEqual(
+                    self.Carrier.get_pricelist_stats()['calls'], {}
+                )
+
+                CONFIG['carrier_pricelist_stats'] = True
+                try:
+                    self.Sale.quote([sale])
+                finally:
+                    CONFIG['carrier_pricelist_stats'] = False
+
+            calls = self.Carrier.get_pricelist_stats()['calls']
+            self.assertEqual(
+                set(calls), set([
+                    'sale.update_pricelist_shipment_costs',
+                    'sale.get_pricelist_shipping_costs',
+                    'currency.compute',
+                    'sale.line.write',
+                ])
+            )
+            update = calls['sale.update_pricelist_shipment_costs']
+            self.assertEqual(update['calls'], 1)
+            self.assertEqual(update['lines'], 4)
+            # The prices and the units of the 2 products and their
+            # conversion computed before are served from the cache
+            self.assertEqual(update['products'], 0)
+            self.assertEqual(update['cache_hits'], 5)
+            self.assertTrue(update['queries'] > 0)
+            self.assertTrue(
+                update['duration'] >= calls['sale.line.write']['duration']
+            )
+
+    def test_0120_compiled_price_list_formulas(self):
+        """Price list formulas are compiled once and constants detected
+        """
+        PriceListLine = POOL.get('product.price_list.line')
+
+        with Transaction().start(DB_NAME, USER, context=CONTEXT):
+            self.setup_defaults()
+
+            line, = self.carrier.price_list.lines
+            code, value = line._get_compiled_formula()
+            self.assertEqual(value, None)
+            self.assertTrue(line._get_compiled_formula()[0] is code)
+
+            PriceListLine.write([line], {'formula': '7.5'})
+            line = PriceListLine(line.id)
+            self.assertEqual(
+                line._get_compiled_formula()[1], Decimal('7.5')
+            )
+
+            sale = self._create_sale(2)
+            with Transaction().set_context(company=self.company.id):
+                self.assertEqual(
+                    sale.get_pricelist_shipping_cost()[0], Decimal('37.5')
+                )
+
+    @unittest.skipIf(vectorize.numpy is None, 'NumPy is not installed')
+    def test_0130_vectorized_shipping_cost(self):
+        """The vectorized engine gives exactly the Decimal total
+        """
+        Carrier = POOL.get('carrier')
+
+        prices = {1: Decimal('2.35'), 2: Decimal('-0.125')}
+        quantities = {(1, 2.5): 3, (1, 4.0): 1, (2, 7.0): 2}
+        self.assertEqual(
+            vectorize.dot(prices, quantities), Decimal('25.275')
+        )
+        # Not representable exactly within the precision of the context
+        self.assertEqual(vectorize.dot(prices, {(1, 0.1): 1}), None)
+        self.assertEqual(vectorize.dot({1: Decimal('1E30')}, {(1, 1): 1}), None)
+
+        with Transaction().start(DB_NAME, USER, context=CONTEXT):
+            self.setup_defaults()
+            self._use_general_price_list()
+            sale = self._create_sale(25)
+
+            with Transaction().set_context(company=self.company.id):
+                expected = sale.get_pricelist_shipping_cost()
+                CONFIG['carrier_pricelist_vectorize'] = True
+                try:
+                    counters.reset()
+                    Carrier.clear_pricelist_caches()
+                    self.assertEqual(
+                        self.Sale(sale.id).get_pricelist_shipping_cost(),
+                        expected
+                    )
+                    self.assertEqual(
+                        counters.get('carrier.pricelist_cost.vectorized'), 1
+                    )
+                finally:
+                    CONFIG['carrier_pricelist_vectorize'] = False
+
+    def test_0140_sql_read_matches_records(self):
+        """The lines and moves read with SQL match the records
+        """
+        Carrier = POOL.get('carrier')
+        Shipment = POOL.get('stock.shipment.out')
+
+        def group(rows):
+            return dict(Carrier.group_pricelist_quantities(rows))
+
+        with Transaction().start(DB_NAME, USER, context=CONTEXT):
+            self.setup_defaults()
+
+            with Transaction().set_context(company=self.company.id):
+                sales = [self._create_sale(10), self._create_sale(4, 3)]
+                self.Sale.quote(sales)
+                sales = self.Sale.browse(sales)
+                rows = self.Sale._read_pricelist_shipping_rows(sales)
+                for sale in sales:
+                    self.assertEqual(
+                        group(rows[sale.id]),
+                        group(sale._get_pricelist_shipping_rows())
+                    )
+                self.assertEqual(sum(
+                    count for _, _, _, count in rows[sales[0].id]
+                ), 10)
+
+                self.Sale.confirm(sales)
+                self.Sale.process(sales)
+                shipments = Shipment.browse([
+                    s.id for sale in sales for s in self.Sale(sale).shipments
+                ])
+                rows = Shipment._read_pricelist_shipping_rows(shipments)
+                for shipment in shipments:
+                    self.assertTrue(rows[shipment.id])
+                    self.assertEqual(
+                        group(rows[shipment.id]),
+                        group(shipment._get_pricelist_shipping_rows())
+                    )
+
+    def test_0150_mixed_units(self):
+        """The quantities are converted to the default unit of the products
+        """
+        SaleLine = POOL.get('sale.line')
+
+        with Transaction().start(DB_NAME, USER, context=CONTEXT):
+            self.setup_defaults()
+            unit, = self.Uom.search([('name', '=', 'Unit')])
+            dozen, = self.Uom.create([{
+                'name': 'Dozen',
+                'symbol': 'dz',
+                'category': unit.category.id,
+                'factor': 12,
+                'rate': 0.083333333333,
+                'rounding': 1,
+                'digits': 0,
+            }])
+
+            with Transaction().set_context(company=self.company.id):
+                sale_units = self._create_sale(1, quantity=24)
+                sale_dozens = self._create_sale(1)
+                SaleLine.write(list(sale_dozens.lines), {'unit': dozen.id})
+
+                sales = self.Sale.browse([sale_units, sale_dozens])
+                costs = self.Sale.get_pricelist_shipping_costs(sales)
+                self.assertTrue(costs[sale_units.id][0])
+                self.assertEqual(
+                    costs[sale_dozens.id], costs[sale_units.id]
+                )
+                sale = self.Sale(sale_dozens.id)
+                self.assertEqual(
+                    sale._get_pricelist_shipping_quantities(),
+                    {(self.product1.id, 24.0): 1}
+                )
+
+    def test_0160_convert_pricelist_costs(self):
+        """The costs are converted like Currency.compute with cached rates
+        """
+        with Transaction().start(DB_NAME, USER, context=CONTEXT):
+            self.setup_defaults()
+            usd = self.currency
+            eur, = self.Currency.create([{
+                'name': 'Euro',
+                'code': 'EUR',
+                'symbol': 'E',
+                'rates': [('create', [{'rate': Decimal('0.7345')}])],
+            }])
+            self.Currency.write([usd], {
+                'rates': [('create', [{'rate': Decimal('1')}])],
+            })
+            costs = [
+                (Decimal('25'), usd.id, eur.id),
+                (Decimal('37.555'), eur.id, usd.id),
+                (Decimal('12.345'), usd.id, usd.id),
+                (Decimal('40'), usd.id, eur.id),
+            ]
+
+            self.Carrier.reset_pricelist_stats()
+            self.assertEqual(
+                self.Carrier.convert_pricelist_costs(costs), [
+                    self.Currency.compute(
+                        self.Currency(from_id), amount, self.Currency(to_id)
+                    ) for amount, from_id, to_id in costs
+                ]
+            )
+            self.Carrier.convert_pricelist_costs(costs)
+            rates, = [
+                c for c in self.Carrier.get_pricelist_stats()['caches']
+                if c['name'] == 'carrier.pricelist_rates'
+            ]
+            self.assertEqual((rates['hits'], rates['misses']), (3, 3))
+
+    def test_0170_bulk_shipment_costs(self):
+        """The costs of many shipments are computed at once and set when
+        they are created
+        """
+        Shipment = POOL.get('stock.shipment.out')
+
+        with Transaction().start(DB_NAME, USER, context=CONTEXT):
+            self.setup_defaults()
+
+            with Transaction().set_context(company=self.company.id):
+                sales = [
+                    self._create_sale(10), self._create_sale(3),
+                    self._create_sale(1),
+                ]
+                self.Sale.quote(sales)
+                self.Sale.confirm(sales)
+                self.Carrier.reset_pricelist_stats()
+                CONFIG['carrier_pricelist_stats'] = True
+                try:
+                    self.Sale.process(sales)
+                finally:
+                    CONFIG['carrier_pricelist_stats'] = False
+                shipments = Shipment.browse([
+                    s.id for sale in sales for s in self.Sale(sale).shipments
+                ])
+
+                # The shipments of all the sales are priced together
+                calls = self.Carrier.get_pricelist_stats()['calls']
+                self.assertEqual(
+                    calls['stock.shipment.out.get_pricelist_shipping_costs'][
+                        'calls'
+                    ], 1
+                )
+                self.assertFalse(
+                    'stock.shipment.out.get_pricelist_shipping_cost' in calls
+                )
+
+                costs = Shipment.get_pricelist_shipping_costs(shipments)
+                self.assertEqual(costs, dict(
+                    (s.id, s.get_pricelist_shipping_cost()) for s in shipments
+                ))
+                self.assertEqual(costs[shipments[0].id][0], Decimal('145'))
+                for shipment in shipments:
+                    self.assertEqual(
+                        (shipment.cost, shipment.cost_currency.id),
+                        costs[shipment.id]
+                    )
+
+                # The cost edited by the user is kept on pack
+                Shipment.write([shipments[0]], {'cost': Decimal('99')})
+                Shipment.assign_force(shipments)
+                Shipment.pack(shipments)
+                shipments = Shipment.browse(shipments)
+                self.assertEqual(shipments[0].cost, Decimal('99'))
+                for shipment in shipments[1:]:
+                    self.assertEqual(
+                        (shipment.cost, shipment.cost_currency.id),
+                        costs[shipment.id]
+                    )
+
+    def test_0180_deferred_shipping_costs(self):
+        """The shipping lines are computed by the queue in deferred mode
+        """
+        with Transaction().start(DB_NAME, USER, context=CONTEXT):
+            self.setup_defaults()
+
+            with Transaction().set_context(company=self.company.id):
+                sales = [self._create_sale(2), self._create_sale(3)]
+
+                CONFIG['carrier_pricelist_deferred'] = True
+                try:
+                    self.Sale.quote(sales)
+                finally:
+                    CONFIG['carrier_pricelist_deferred'] = False
+
+            sales = self.Sale.browse(sales)
+            for sale in sales:
+                self.assertTrue(sale.pricelist_shipping_pending)
+                self.assertFalse([l for l in sale.lines if l.shipment_cost])
+
+            # Requested again while pending
+            self.Sale.enqueue_pricelist_shipment_costs(sales + sales)
+
+            counters.reset()
+            self.Sale.process_pricelist_shipping_queue(batch_size=1)
+            self.assertEqual(counters.get('sale.shipping_queue.processed'), 2)
+            for sale, cost in zip(self.Sale.browse(sales), [25, 45]):
+                self.assertFalse(sale.pricelist_shipping_pending)
+                line, = [l for l in sale.lines if l.shipment_cost]
+                self.assertEqual(line.amount, Decimal(cost))
+
+            self.Sale.process_pricelist_shipping_queue()
+            self.assertEqual(counters.get('sale.shipping_queue.processed'), 2)
+
+            # Copies and cancelled sales are not computed by the queue
+            with Transaction().set_context(company=self.company.id):
+                sales = [self._create_sale(2), self._create_sale(3)]
+                CONFIG['carrier_pricelist_deferred'] = True
+                try:
+                    self.Sale.quote(sales)
+                finally:
+                    CONFIG['carrier_pricelist_deferred'] = False
+                copy, = self.Sale.copy([sales[0]])
+                self.assertFalse(copy.pricelist_shipping_pending)
+                self.Sale.cancel([sales[1]])
+                self.assertFalse(self.Sale(sales[1]).pricelist_shipping_pending)
+
+                counters.reset()
+                self.Sale.process_pricelist_shipping_queue()
+                self.assertEqual(
+                    counters.get('sale.shipping_queue.processed'), 1
+                )
+                for sale in [copy, sales[1]]:
+                    sale = self.Sale(sale.id)
+                    self.assertFalse(
+                        [l for l in sale.lines if l.shipment_cost]
+                    )
+
+            # Still pending sales are computed on confirmation
+            with Transaction().set_context(company=self.company.id):
+                sale = self._create_sale(2)
+                CONFIG['carrier_pricelist_deferred'] = True
+                try:
+                    self.Sale.quote([sale])
+                finally:
+                    CONFIG['carrier_pricelist_deferred'] = False
+                self.Sale.confirm([sale])
+            sale = self.Sale(sale.id)
+            self.assertFalse(sale.pricelist_shipping_pending)
+            self.assertTrue([l for l in sale.lines if l.shipment_cost])
+
+            # The user of the cron has no company
+            ModelData = POOL.get('ir.model.data')
+            cron_user = ModelData.get_id(
+                'carrier_pricelist', 'user_carrier_pricelist_cron'
+            )
+            with Transaction().set_context(company=self.company.id):
+                sale = self._create_sale(2)
+                CONFIG['carrier_pricelist_deferred'] = True
+                try:
+                    self.Sale.quote([sale])
+                finally:
+                    CONFIG['carrier_pricelist_deferred'] = False
+            with Transaction().set_user(cron_user), \
+                    Transaction().set_context(company=None):
+                self.Sale.process_pricelist_shipping_queue()
+            sale = self.Sale(sale.id)
+            self.assertFalse(sale.pricelist_shipping_pending)
+            line, = [l for l in sale.lines if l.shipment_cost]
+            self.assertEqual(line.amount, Decimal('25'))
+
+    def test_0190_constant_price_list(self):
+        """Constant price lists are detected and priced without the products
+        """
+        PriceListLine = POOL.get('product.price_list.line')
+
+        with Transaction().start(DB_NAME, USER, context=CONTEXT):
+            self.setup_defaults()
+            sale = self._create_sale(7)
+
+            def kind():
+                carrier = self.Carrier(self.carrier.id)
+                return carrier.pricelist_kind, carrier.pricelist_rate
+
+            self.assertEqual(kind(), ('constant', Decimal('5')))
+            with Transaction().set_context(company=self.company.id):
+                counters.reset()
+                self.assertEqual(
+                    sale.get_pricelist_shipping_cost()[0],
+                    self._get_per_line_shipping_cost(sale)
+                )
+                self.assertEqual(
+                    counters.get('carrier.pricelist_cost.constant'), 1
+                )
+
+            flat_rate, = self.carrier.price_list.lines
+            PriceListLine.write([flat_rate], {'sequence': 10})
+            line, = PriceListLine.create([{
+                'price_list': self.carrier.price_list.id,
+                'sequence': 1,
+                'product': self.product1.id,
+                'formula': '5.0',
+            }])
+            self.assertEqual(kind(), ('constant', Decimal('5')))
+
+            PriceListLine.write([line], {'formula': '6.0'})
+            self.assertEqual(kind(), ('product', None))
+
+            PriceListLine.write([line], {
+                'formula': "unit_price + "
+                "(Decimal('1') if locals() else Decimal('0'))",
+            })
+            self.assertEqual(kind(), ('general', None))
+
+            PriceListLine.delete([line])
+            self.assertEqual(kind(), ('constant', Decimal('5')))
+
+            self.Carrier.write([self.carrier], {
+                'carrier_cost_method': 'product',
+            })
+            self.assertEqual(kind(), (None, None))
+
+    def test_0200_materialized_rates(self):
+        """Price lists depending on the product are priced from the
+        materialized rates
+        """
+        PriceListLine = POOL.get('product.price_list.line')
+        Rate = POOL.get('carrier.pricelist.rate')
+        SaleLine = POOL.get('sale.line')
+
+        with Transaction().start(DB_NAME, USER, context=CONTEXT):
+            self.setup_defaults()
+            self.assertEqual(Rate.search([]), [])
+
+            line, = self.carrier.price_list.lines
+            PriceListLine.write([line], {'formula': 'unit_price * 0.1'})
+            self.assertEqual(
+                self.Carrier(self.carrier.id).pricelist_kind, 'product'
+            )
+            rates = Rate.search([('carrier', '=', self.carrier.id)])
+            self.assertEqual(len(rates), self.Product.search([], count=True))
+
+            def rate_ids():
+                return dict((r.product.id, r.id) for r in Rate.search([
+                    ('carrier', '=', self.carrier.id),
+                ]))
+
+            # Only the rates of the products of the changed lines and of the
+            # changed prices are refreshed
+            before = rate_ids()
+            product_line, = PriceListLine.create([{
+                'price_list': self.carrier.price_list.id,
+                'sequence': 0,
+                'product': self.product2.id,
+                'formula': 'unit_price * 0.1',
+            }])
+            self.ProductTemplate.write([self.template1], {
+                'name': 'Renamed Product 1',
+            })
+            after = rate_ids()
+            self.assertNotEqual(
+                before.pop(self.product2.id), after.pop(self.product2.id)
+            )
+            self.assertEqual(before, after)
+            PriceListLine.delete([product_line])
+
+            sale = self._create_sale(4)
+            with Transaction().set_context(company=self.company.id):
+                counters.reset()
+                self.assertEqual(
+                    sale.get_pricelist_shipping_cost()[0], Decimal('85')
+                )
+                self.assertEqual(
+                    self._get_per_line_shipping_cost(sale), Decimal('85')
+                )
+                self.assertEqual(
+                    counters.get('carrier.pricelist_cost.materialized'), 1
+                )
+
+                # The rates of the product are refreshed
+                self.ProductTemplate.write([self.template1], {
+                    'list_price': Decimal('200'),
+                })
+                self.assertEqual(
+                    self.Sale.get_pricelist_shipping_costs([sale]),
+                    {sale.id: (Decimal('145'), self.currency.id)}
+                )
+                self.assertEqual(
+                    counters.get('carrier.pricelist_cost.materialized'), 2
+                )
+
+                self.Sale.quote([sale])
+                self.Sale.confirm([sale])
+                self.Sale.process([sale])
+                shipment, = self.Sale(sale.id).shipments
+                counters.reset()
+                self.assertEqual(
+                    shipment.get_pricelist_shipping_cost()[0], Decimal('145')
+                )
+                self.assertEqual(
+                    counters.get('carrier.pricelist_cost.materialized'), 1
+                )
+
+                # A line in another unit is priced by the price list
+                unit, = self.Uom.search([('name', '=', 'Unit')])
+                dozen, = self.Uom.create([{
+                    'name': 'Dozen',
+                    'symbol': 'dz',
+                    'category': unit.category.id,
+                    'factor': 12,
+                    'rate': 0.083333333333,
+                    'rounding': 1,
+                    'digits': 0,
+                }])
+                sale = self._create_sale(1)
+                SaleLine.write(list(sale.lines), {'unit': dozen.id})
+                self.assertEqual(
+                    self.Sale(sale.id).get_pricelist_shipping_cost()[0],
+                    Decimal('480')
+                )
+                self.assertEqual(
+                    counters.get('carrier.pricelist_cost.materialized'), 1
+                )
+
+            # The cron user has no company
+            ModelData = POOL.get('ir.model.data')
+            cron_user = ModelData.get_id(
+                'carrier_pricelist', 'user_carrier_pricelist_cron'
+            )
+            Rate.delete(Rate.search([]))
+            with Transaction().set_user(cron_user), \
+                    Transaction().set_context(company=None):
+                Rate.rebuild()
+            self.assertEqual(len(Rate.search([])), len(rates))
+
+            # The products of a user of another company refresh the rates
+            with Transaction().set_context(company=None):
+                party, = self.Party.create([{'name': 'Other Company'}])
+            company, = self.Company.create([{
+                'party': party.id,
+                'currency': self.currency.id,
+            }])
+            user, = self.User.create([{
+                'name': 'Other Salesman',
+                'login': 'other_salesman',
+                'main_company': company.id,
+                'company': company.id,
+                'groups': [('add', [
+                    ModelData.get_id('product', 'group_product_admin'),
+                ])],
+            }])
+            with Transaction().set_user(user.id), \
+                    Transaction().set_context(company=company.id):
+                product, = self.Product.create([{
+                    'template': self.template2.id,
+                }])
+                self.ProductTemplate.write([self.template2], {
+                    'list_price': Decimal('300'),
+                })
+            # The list price of the other company is not the one of the
+            # company of the price list
+            rate, = Rate.search([
+                ('carrier', '=', self.carrier.id),
+                ('product', '=', product.id),
+            ])
+            self.assertEqual(rate.rate, Decimal('5'))
+
+            # Only the carrier administrators change the rates
+            with Transaction().set_user(user.id), \
+                    Transaction().set_context(company=company.id):
+                self.assertEqual(len(Rate.search([])), len(rates) + 1)
+                self.assertRaises(
+                    UserError, Rate.write, [rate], {'rate': Decimal('0')}
+                )
+
+    def test_0210_quote_pricelist_rates(self):
+        """Rates of products which are not in a sale
+        """
+        with Transaction().start(DB_NAME, USER, context=CONTEXT):
+            self.setup_defaults()
+            self._use_general_price_list()
+            unit = self.product1.default_uom
+
+            with Transaction().set_context(company=self.company.id):
+                sale = self._create_sale(5)
+                expected = sale.get_pricelist_shipping_cost()[0]
+                items = [
+                    (line.product.id, line.quantity, unit.id)
+                    for line in sale.lines
+                ] + [(None, 1, None), (self.product2.id, 0, unit.id)]
+
+                sale_count = self.Sale.search([], count=True)
+                self.assertEqual(
+                    self.Carrier.quote_pricelist_rates(
+                        items, self.sale_party.id, self.currency.id
+                    ), [(
+                        self.carrier.party.name, expected, self.currency.id,
+                        {}, {'carrier_id': self.carrier.id},
+                    )]
+                )
+                self.assertEqual(
+                    self.Carrier.quote_pricelist_rates(
+                        items, self.sale_party.id, self.currency.id,
+                        carriers=[self.carrier.id]
+                    )[0][1], expected
+                )
+                self.assertEqual(
+                    self.Sale.search([], count=True), sale_count
+                )
+
+    def test_0220_quote_pricelist_rates_batch(self):
+        """Rates of many carts in one call
+        """
+        with Transaction().start(DB_NAME, USER, context=CONTEXT):
+            self.setup_defaults()
+            self._use_general_price_list()
+            unit = self.product1.default_uom.id
+            customer, currency = self.sale_party.id, self.currency.id
+
+            carts = [{
+                'items': [(self.product1.id, 2, unit)],
+                'customer': customer,
+                'currency': currency,
+            }, {
+                'items': [(self.product1.id, 1, unit), (999999, 1, unit)],
+                'customer': customer,
+                'currency': currency,
+            }, {
+                'items': [(self.product2.id, 3, unit)],
+            }, {
+                'items': [
+                    (self.product1.id, 4, unit), (self.product2.id, 1, unit),
+                ],
+                'customer': customer,
+                'currency': currency,
+            }, 'not a cart', {
+                'items': [('1; DROP TABLE sale_sale', 1, unit)],
+                'customer': customer,
+                'currency': currency,
+            }, {
+                'items': [self.product1.id],
+                'customer': customer,
+                'currency': currency,
+            }]
+
+            with Transaction().set_context(company=self.company.id):
+                cache = self.Carrier._pricelist_prices_cache
+                cache.reset_stats()
+                results = self.Carrier.quote_pricelist_rates_batch(carts)
+                # The products of the carts are priced once
+                self.assertEqual(cache.stats()['misses'], 2)
+
+                self.assertEqual(len(results), 7)
+                for result in results[4:]:
+                    self.assertTrue('error' in result)
+                self.assertEqual(results[0], {
+                    'rates': self.Carrier.quote_pricelist_rates(
+                        carts[0]['items'], customer, currency
+                    ),
+                })
+                self.assertEqual(results[0]['rates'][0][1], Decimal('10'))
+                self.assertTrue('999999' in results[1]['error'])
+                self.assertTrue('KeyError' in results[2]['error'])
+                self.assertEqual(results[3]['rates'][0][1], Decimal('25'))
+
+    @unittest.skipIf(
+        CONFIG['db_type'] == 'sqlite',
+        'SQLite connections can not be shared between the test threads'
+    )
+    def test_0230_concurrent_shipping_lines(self):
+        """Concurrent updates of a sale end with a single shipping line
+        """
+        with Transaction().start(DB_NAME, USER, context=CONTEXT) as txn:
+            self.setup_defaults()
+            self._use_general_price_list()
+            with Transaction().set_context(company=self.company.id):
+                sale = self._create_sale(2)
+            sale_id, product_id = sale.id, self.product1.id
+            unit_id = self.product1.default_uom.id
+            context = dict(CONTEXT, company=self.company.id)
+            txn.cursor.commit()
+
+        try:
+            self._check_concurrent_shipping_lines(
+                sale_id, product_id, unit_id, context
+            )
+        finally:
+            # The committed data must not be seen by the other tests
+            with Transaction().start(DB_NAME, USER, context=context) as txn:
+                self._delete_defaults([sale_id])
+                txn.cursor.commit()
+
+    def _check_concurrent_shipping_lines(
+            self, sale_id, product_id, unit_id, context):
+        "Update the shipping line of the committed sale from many threads"
+        DatabaseOperationalError = backend.get('DatabaseOperationalError')
+        SaleLine = POOL.get('sale.line')
+
+        errors = []
+
+        def quote():
+            # Each worker adds a line and updates the shipping line, retried
+            # on serialization errors like the dispatcher does
+            for _ in range(20):
+                with Transaction().start(DB_NAME, USER, context=context) \
+                        as transaction:
+                    try:
+                        SaleLine.create([{
+                            'sale': sale_id,
+                            'type': 'line',
+                            'quantity': 1,
+                            'product': product_id,
+                            'unit': unit_id,
+                            'unit_price': Decimal('100'),
+                            'description': 'Concurrent line',
+                        }])
+                        self.Sale.update_pricelist_shipment_costs(
+                            self.Sale.browse([sale_id])
+                        )
+                        transaction.cursor.commit()
+                        return
+                    except DatabaseOperationalError:
+                        transaction.cursor.rollback()
+                        time.sleep(0.01)
+            errors.append('Too many retries')
+
+        workers = [threading.Thread(target=quote) for _ in range(8)]
+        for worker in workers:
+            worker.start()
+        for worker in workers:
+            worker.join()
+        self.assertFalse(errors)
+
+        with Transaction().start(DB_NAME, USER, context=CONTEXT):
+            sale = self.Sale(sale_id)
+            shipping_lines = [l for l in sale.lines if l.shipment_cost]
+            self.assertEqual(len(sale.lines), 2 + 8 + 1)
+            # No line added by a worker is missing from the cost
+            line, = shipping_lines
+            self.assertEqual(line.amount, Decimal('65'))
+
+    def test_0240_tier_cost_method(self):
+        """Carriers bill by weight and volume bands
+        """
+        Shipment = POOL.get('stock.shipment.out')
+
+        with Transaction().start(DB_NAME, USER, context=CONTEXT):
+            self.setup_defaults()
+            kilogram, = self.Uom.search([('symbol', '=', 'kg')])
+            centimeter, = self.Uom.search([('symbol', '=', 'cm')])
+            liter, = self.Uom.search([('symbol', '=', 'l')])
+
+            self.ProductTemplate.write([self.template1], {
+                'weight': 2.0,
+                'weight_uom': kilogram.id,
+                'length': 10.0,
+                'length_uom': centimeter.id,
+                'height': 10.0,
+                'height_uom': centimeter.id,
+                'width': 10.0,
+                'width_uom': centimeter.id,
+            }, [self.template2], {
+                'weight': 500.0,
+                'weight_uom': self.Uom.search([('symbol', '=', 'g')])[0].id,
+                'length': 10.0,
+                'length_uom': centimeter.id,
+                'height': 10.0,
+                'height_uom': centimeter.id,
+                'width': 1.0,
+                'width_uom': centimeter.id,
+            })
+            carrier_party, = self.Party.create([{
+                'name': 'Tier Carrier',
+            }])
+            self.carrier, = self.Carrier.create([{
+                'party': carrier_party.id,
+                'carrier_cost_method': 'tier',
+                'carrier_product': self.carrier.carrier_product.id,
+                'tier_weight_uom': kilogram.id,
+                'tier_volume_uom': liter.id,
+                'tiers': [('create', [{
+                    'measure': 'weight',
+                    'maximum': maximum,
+                    'price': price,
+                } for maximum, price in [
+                    (Decimal('20'), Decimal('25')),
+                    (Decimal('5'), Decimal('10')),
+                    (Decimal('50'), Decimal('40')),
+                ]] + [{
+                    'measure': 'volume',
+                    'maximum': maximum,
+                    'price': price,
+                } for maximum, price in [
+                    (Decimal('3'), Decimal('5')),
+                    (Decimal('100'), Decimal('30')),
+                ]])],
+            }])
+
+            breakpoints = self.carrier.get_tier_breakpoints()
+            self.assertEqual(breakpoints['weight'], (
+                [5.0, 20.0, 50.0], [Decimal('10'), Decimal('25'), Decimal('40')]
+            ))
+            maximums, prices = breakpoints['weight']
+            self.assertEqual(
+                self.carrier.get_tier_price(maximums, prices, 0), 10
+            )
+            self.assertEqual(
+                self.carrier.get_tier_price(maximums, prices, 5.0), 10
+            )
+            self.assertEqual(
+                self.carrier.get_tier_price(maximums, prices, 5.5), 25
+            )
+            self.assertEqual(
+                self.carrier.get_tier_price(maximums, prices, 50.5), None
+            )
+
+            product1, product2 = self.product1.id, self.product2.id
+            with Transaction().set_context(company=self.company.id):
+                # 5.5 kg and 2.3 l
+                sale = self._create_sale(2)
+                self.assertEqual(
+                    self.carrier.get_tier_measures(
+                        self.Sale.get_pricelist_shipping_quantities(
+                            [sale]
+                        )[sale.id]
+                    ), {'weight': 5.5, 'volume': 2.3}
+                )
+                with Transaction().set_context(sale=sale.id):
+                    self.assertEqual(
+                        self.carrier.get_sale_price(),
+                        (Decimal('25'), self.currency.id)
+                    )
+
+                # The volume band is the more expensive
+                self.assertEqual(
+                    self.carrier.get_tier_cost({(product1, 4): 1}), 30
+                )
+                self.assertEqual(
+                    self.carrier.get_tier_cost({(product2, 1): 4}), 10
+                )
+                self.assertRaises(
+                    UserError, self.carrier.get_tier_cost,
+                    {(product1, 13): 2}
+                )
+
+                # The edited lines are priced from the record
+                sale.lines = list(sale.lines)
+                values = sale.on_change_lines()
+                cost_line, = [
+                    line for _, line in values['lines']['add']
+                    if line.get('shipment_cost')
+                ]
+                self.assertEqual(cost_line['shipment_cost'], Decimal('25'))
+
+                sale = self.Sale(sale.id)
+                self.Sale.quote([sale])
+                self.Sale.confirm([sale])
+                self.Sale.process([sale])
+                shipment, = Shipment.browse(self.Sale(sale).shipments)
+                self.assertEqual(shipment.cost, Decimal('25'))
+
+                # A product without weight is not priced as weightless
+                self.ProductTemplate.write([self.template2], {'weight': None})
+                self.assertRaises(
+                    UserError, self.carrier.get_tier_cost, {(product2, 1): 1}
+                )
+
+            # Only the carrier administrators change the tiers
+            Tier = POOL.get('carrier.tier')
+            user, = self.User.create([{
+                'name': 'Salesman',
+                'login': 'salesman',
+            }])
+            with Transaction().set_user(user.id):
+                tiers = Tier.search([('carrier', '=', self.carrier.id)])
+                self.assertEqual(len(tiers), 5)
+                self.assertRaises(
+                    UserError, Tier.write, tiers, {'price': Decimal('0')}
+                )
+
+    def test_0250_zone_rate_matrix(self):
+        """The zone of the destination multiplies or increases the cost
+        """
+        Address = POOL.get('party.address')
+        Shipment = POOL.get('stock.shipment.out')
+
+        with Transaction().start(DB_NAME, USER, context=CONTEXT):
+            self.setup_defaults()
+            self._use_general_price_list()
+            country, = self.Country.create([{
+                'name': 'United States',
+                'code': 'US',
+            }])
+            idaho, = self.Subdivision.create([{
+                'country': country.id,
+                'name': 'Idaho',
+                'code': 'US-ID',
+                'type': 'state',
+            }])
+            self.Carrier.write([self.carrier], {
+                'zones': [('create', [{
+                    'name': 'Idaho',
+                    'sequence': 10,
+                    'subdivisions': [('add', [idaho.id])],
+                    'multiplier': Decimal('2'),
+                }, {
+                    'name': 'Boise',
+                    'sequence': 20,
+                    'zips': [('create', [{
+                        'country': country.id,
+                        'prefix': '837',
+                    }])],
+                    'surcharge': Decimal('3'),
+                }, {
+                    'name': 'United States',
+                    'sequence': 30,
+                    'countries': [('add', [country.id])],
+                    'multiplier': Decimal('1.5'),
+                }, {
+                    'name': 'Shadowed',
+                    'sequence': 40,
+                    'countries': [('add', [country.id])],
+                    'multiplier': Decimal('9'),
+                }])],
+            })
+
+            index = self.carrier.get_zone_index()
+            self.assertEqual(index, {
+                (country.id, idaho.id, None): (2, 0),
+                (country.id, None, '837'): (1, 3),
+                (country.id, None, None): (Decimal('1.5'), 0),
+            })
+            self.assertTrue(self.carrier.get_zone_index() is index)
+
+            address = self.sale_party.addresses[0]
+            with Transaction().set_context(company=self.company.id):
+                sale = self._create_sale(2)
+                for values, cost in [
+                        ({}, Decimal('25')),
+                        ({'country': country.id, 'zip': None},
+                            Decimal('37.5')),
+                        ({'subdivision': idaho.id}, Decimal('50')),
+                        ({'zip': '837-02'}, Decimal('28'))]:
+                    Address.write([address], values)
+                    sale = self.Sale(sale.id)
+                    self.assertEqual(
+                        sale.get_pricelist_shipping_cost(),
+                        (cost, self.currency.id)
+                    )
+                    self.assertEqual(
+                        self.Sale.get_pricelist_shipping_costs([sale]),
+                        {sale.id: (cost, self.currency.id)}
+                    )
+
+                # The same products quoted without a sale
+                items = [
+                    (l.product.id, l.quantity, l.unit.id) for l in sale.lines
+                ]
+                customer, currency = self.sale_party.id, self.currency.id
+                for destination, cost in [
+                        (None, Decimal('25')),
+                        (address.id, Decimal('28')),
+                        ({'country': country.id}, Decimal('37.5')),
+                        ({'country': country.id, 'subdivision': idaho.id},
+                            Decimal('50')),
+                        ({'country': country.id, 'zip': '83702'},
+                            Decimal('28'))]:
+                    rates = self.Carrier.quote_pricelist_rates(
+                        items, customer, currency, destination=destination
+                    )
+                    self.assertEqual(rates[0][1], cost)
+                self.assertRaises(
+                    UserError, self.Carrier.quote_pricelist_rates,
+                    items, customer, currency, destination={'zip': '83702'}
+                )
+
+                results = self.Carrier.quote_pricelist_rates_batch([{
+                    'items': items,
+                    'customer': customer,
+                    'currency': currency,
+                    'destination': destination,
+                } for destination in [
+                    None, {'country': country.id}, address.id, 999999,
+                    {'country': 'US'},
+                ]])
+                self.assertEqual(
+                    [r['rates'][0][1] for r in results[:3]],
+                    [Decimal('25'), Decimal('37.5'), Decimal('28')]
+                )
+                self.assertTrue('999999' in results[3]['error'])
+                self.assertTrue('Invalid destination' in results[4]['error'])
+
+                self.Sale.quote([sale])
+                sale = self.Sale(sale.id)
+                line, = [l for l in sale.lines if l.shipment_cost]
+                self.assertEqual(line.amount, Decimal('28'))
+
+                self.Sale.confirm([sale])
+                self.Sale.process([sale])
+                shipment, = Shipment.browse(self.Sale(sale).shipments)
+                self.assertEqual(
+                    shipment.get_pricelist_shipping_cost(),
+                    (Decimal('28'), self.currency.id)
+                )
+
+            # Only the carrier administrators change the zones
+            Zone = POOL.get('carrier.zone')
+            ZoneZip = POOL.get('carrier.zone.zip')
+            user, = self.User.create([{
+                'name': 'Salesman',
+                'login': 'salesman',
+            }])
+            with Transaction().set_user(user.id):
+                zones = Zone.search([('carrier', '=', self.carrier.id)])
+                self.assertEqual(len(zones), 4)
+                self.assertRaises(
+                    UserError, Zone.write, zones, {'surcharge': Decimal('0')}
+                )
+                self.assertRaises(
+                    UserError, ZoneZip.write, ZoneZip.search([]),
+                    {'prefix': '8'}
+                )
+                self.assertRaises(
+                    UserError, Zone.write, zones,
+                    {'countries': [('add', [country.id])]}
+                )
+
+    def test_0260_shipping_lock_write_date(self):
+        """The lock of the shipping lines changes only the sales whose
+        shipping line changed
+        """
+        SaleLine = POOL.get('sale.line')
+
+        with Transaction().start(DB_NAME, USER, context=CONTEXT):
+            self.setup_defaults()
+            self._use_general_price_list()
+            table = self.Sale.__table__()
+            cursor = Transaction().cursor
+
+            def reset_write_date():
+                cursor.execute(*table.update(
+                    columns=[table.write_date], values=[None]
+                ))
+
+            def write_date():
+                cursor.execute(*table.select(
+                    table.write_date, where=table.id == sale.id
+                ))
+                return cursor.fetchone()[0]
+
+            with Transaction().set_context(company=self.company.id):
+                sale = self._create_sale(2)
+                reset_write_date()
+                self.Sale.lock_pricelist_shipping([sale])
+                self.assertEqual(write_date(), None)
+
+                self.Sale.update_pricelist_shipment_costs([sale])
+                self.assertNotEqual(write_date(), None)
+
+                # The shipping line is up to date
+                reset_write_date()
+                self.Sale.update_pricelist_shipment_costs([sale])
+                self.assertEqual(write_date(), None)
+
+                SaleLine.create([{
+                    'sale': sale.id,
+                    'type': 'line',
+                    'quantity': 1,
+                    'product': self.product1.id,
+                    'unit': self.product1.default_uom.id,
+                    'unit_price': Decimal('100'),
+                    'description': 'New line',
+                }])
+                reset_write_date()
+                self.Sale.update_pricelist_shipment_costs([sale])
+                self.assertNotEqual(write_date(), None)
+                sale = self.Sale(sale.id)
+                line, = [l for l in sale.lines if l.shipment_cost]
+                self.assertEqual(line.amount, Decimal('30'))
+
 
 def suite():
     """
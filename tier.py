@@ -0,0 +1,66 @@
+# -*- coding: utf-8 -*-
+"""
+    tier.py
+
+    :copyright: (c) 2014 by Openlabs Technologies & Consulting (P) Limited
+    :license: BSD, see LICENSE for more details.
+"""
+from trytond.model import ModelSQL, ModelView, fields
+from trytond.pool import Pool
+
+__all__ = ['CarrierTier']
+
+
+class CarrierTier(ModelSQL, ModelView):
+    """
+    Carrier Tier
+
+    The price of a weight or volume band of a carrier using the tier cost
+    method. A band covers the measures up to its maximum and above the
+    maximum of the previous band.
+    """
+    __name__ = 'carrier.tier'
+
+    carrier = fields.Many2One(
+        'carrier', 'Carrier', required=True, select=True, ondelete='CASCADE'
+    )
+    measure = fields.Selection([
+        ('weight', 'Weight'),
+        ('volume', 'Volume'),
+    ], 'Measure', required=True)
+    maximum = fields.Numeric('Up To', required=True)
+    price = fields.Numeric('Price', required=True)
+
+    @classmethod
+    def __setup__(cls):
+        super(CarrierTier, cls).__setup__()
+        cls._order.insert(0, ('measure', 'ASC'))
+        cls._order.insert(1, ('maximum', 'ASC'))
+        cls._sql_constraints += [
+            ('carrier_measure_maximum_uniq',
+                'UNIQUE(carrier, measure, maximum)',
+                'The maximum of a tier must be unique per measure.'),
+        ]
+
+    @staticmethod
+    def default_measure():
+        return 'weight'
+
+    @staticmethod
+    def clear_tiers_cache():
+        Pool().get('carrier')._tiers_cache.clear()
+
+    @classmethod
+    def create(cls, vlist):
+        cls.clear_tiers_cache()
+        return super(CarrierTier, cls).create(vlist)
+
+    @classmethod
+    def write(cls, *args):
+        cls.clear_tiers_cache()
+        super(CarrierTier, cls).write(*args)
+
+    @classmethod
+    def delete(cls, tiers):
+        cls.clear_tiers_cache()
+        super(CarrierTier, cls).delete(tiers)
@@ -0,0 +1,109 @@
+# -*- coding: utf-8 -*-
+"""
+    vectorize.py
+
+    Reduction of the pricelist shipping cost as a dot product of fixed point
+    integer arrays, used when NumPy is installed.
+
+    :copyright: (c) 2014 by Openlabs Technologies & Consulting (P) Limited
+    :license: BSD, see LICENSE for more details.
+"""
+from decimal import Decimal, getcontext
+
+from trytond.config import CONFIG
+
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+__all__ = ['enabled', 'fixed_point', 'dot']
+
+# The largest integer which can be accumulated in an int64 array
+_INT64_MAX = 2 ** 63 - 1
+
+
+def enabled():
+    """The engine is enabled with carrier_pricelist_vectorize = True and
+    only available when NumPy is installed
+    """
+    return numpy is not None and \
+        bool(CONFIG.get('carrier_pricelist_vectorize'))
+
+
+def fixed_point(values):
+    """Convert the numbers to integers sharing the same decimal exponent
+
+    The conversion is exact, floats are converted with their full binary
+    expansion like ``Decimal(float)`` does.
+
+    :param values: A list of Decimal, int or float
+    :returns: A tuple of (list of integers, exponent) or None if a value is
+        not finite
+    """
+    tuples = []
+    for value in values:
+        if not isinstance(value, Decimal):
+            value = Decimal(value)
+        if not value.is_finite():
+            return
+        tuples.append(value.as_tuple())
+    exponent = min([t.exponent for t in tuples] + [0])
+    integers = []
+    for sign, digits, value_exponent in tuples:
+        integer = int(''.join(map(str, digits)) or '0') * \
+            10 ** (value_exponent - exponent)
+        integers.append(-integer if sign else integer)
+    return integers, exponent
+
+
+def dot(prices, quantities):
+    """Return the total of the prices multiplied by the quantities
+
+    The quantities and the prices gathered by product are loaded in int64
+    arrays and reduced with a single dot product. The total is only returned
+    when it is exactly the one of the Decimal arithmetic, that is when no
+    intermediate value overflows the arrays or the precision of the decimal
+    context.
+
+    :param prices: A dictionary of product id: price
+    :param quantities: A dictionary of (product id, quantity): count
+    :returns: A Decimal or None when the total can not be computed exactly
+    """
+    if numpy is None or not quantities:
+        return
+
+    product_ids = sorted(prices)
+    index = dict((product_id, i) for i, product_id in enumerate(product_ids))
+    keys = quantities.keys()
+
+    price_values = fixed_point([prices[p] for p in product_ids])
+    quantity_values = fixed_point([quantity for _, quantity in keys])
+    if price_values is None or quantity_values is None:
+        return
+    price_integers, price_exponent = price_values
+    quantity_integers, quantity_exponent = quantity_values
+
+    # The bound of the sum of the absolute values of the terms
+    bound = max(map(abs, price_integers) or [0]) * sum(
+        abs(integer) * quantities[key]
+        for integer, key in zip(quantity_integers, keys)
+    )
+    if bound > _INT64_MAX or len(str(bound)) > getcontext().prec:
+        return
+
+    price_vector = numpy.array(price_integers, dtype=numpy.int64)
+    positions = numpy.fromiter(
+        (index[product_id] for product_id, _ in keys),
+        dtype=numpy.intp, count=len(keys)
+    )
+    quantity_vector = numpy.array([
+        integer * quantities[key]
+        for integer, key in zip(quantity_integers, keys)
+    ], dtype=numpy.int64)
+    total = int(numpy.dot(price_vector[positions], quantity_vector))
+
+    sign = 1 if total < 0 else 0
+    return Decimal((
+        sign, map(int, str(abs(total))), price_exponent + quantity_exponent
+    ))
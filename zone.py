@@ -0,0 +1,160 @@
+# -*- coding: utf-8 -*-
+"""
+    zone.py
+
+    :copyright: (c) 2014 by Openlabs Technologies & Consulting (P) Limited
+    :license: BSD, see LICENSE for more details.
+"""
+from trytond.model import ModelSQL, ModelView, fields
+from trytond.pool import Pool
+
+__all__ = [
+    'CarrierZone', 'CarrierZoneCountry', 'CarrierZoneSubdivision',
+    'CarrierZoneZip', 'normalize_zip',
+]
+
+
+def normalize_zip(code):
+    "Returns the zip code in upper case without blanks and dashes"
+    return ''.join(c for c in (code or '').upper() if c not in ' -')
+
+
+class CarrierZone(ModelSQL, ModelView):
+    """
+    Carrier Zone
+
+    A set of countries, subdivisions and zip prefixes of a carrier whose
+    pricelist shipping cost is multiplied and then increased by a surcharge
+    in the currency of the company.
+    """
+    __name__ = 'carrier.zone'
+
+    carrier = fields.Many2One(
+        'carrier', 'Carrier', required=True, select=True, ondelete='CASCADE'
+    )
+    name = fields.Char('Name', required=True)
+    sequence = fields.Integer('Sequence')
+    countries = fields.Many2Many(
+        'carrier.zone-country.country', 'zone', 'country', 'Countries'
+    )
+    subdivisions = fields.Many2Many(
+        'carrier.zone-country.subdivision', 'zone', 'subdivision',
+        'Subdivisions'
+    )
+    zips = fields.One2Many('carrier.zone.zip', 'zone', 'Zip Prefixes')
+    multiplier = fields.Numeric('Multiplier', required=True)
+    surcharge = fields.Numeric('Surcharge', required=True)
+
+    @classmethod
+    def __setup__(cls):
+        super(CarrierZone, cls).__setup__()
+        cls._order.insert(0, ('sequence', 'ASC'))
+
+    @staticmethod
+    def order_sequence(tables):
+        table, _ = tables[None]
+        return [table.sequence == None, table.sequence]  # noqa
+
+    @staticmethod
+    def default_multiplier():
+        return 1
+
+    @staticmethod
+    def default_surcharge():
+        return 0
+
+    @staticmethod
+    def clear_zones_cache():
+        Pool().get('carrier')._zones_cache.clear()
+
+    @classmethod
+    def create(cls, vlist):
+        cls.clear_zones_cache()
+        return super(CarrierZone, cls).create(vlist)
+
+    @classmethod
+    def write(cls, *args):
+        cls.clear_zones_cache()
+        super(CarrierZone, cls).write(*args)
+
+    @classmethod
+    def delete(cls, zones):
+        cls.clear_zones_cache()
+        super(CarrierZone, cls).delete(zones)
+
+
+class CarrierZoneCountry(ModelSQL):
+    "Carrier Zone - Country"
+    __name__ = 'carrier.zone-country.country'
+
+    zone = fields.Many2One(
+        'carrier.zone', 'Zone', required=True, select=True, ondelete='CASCADE'
+    )
+    country = fields.Many2One(
+        'country.country', 'Country', required=True, select=True,
+        ondelete='CASCADE'
+    )
+
+    @classmethod
+    def create(cls, vlist):
+        CarrierZone.clear_zones_cache()
+        return super(CarrierZoneCountry, cls).create(vlist)
+
+    @classmethod
+    def delete(cls, records):
+        CarrierZone.clear_zones_cache()
+        super(CarrierZoneCountry, cls).delete(records)
+
+
+class CarrierZoneSubdivision(ModelSQL):
+    "Carrier Zone - Subdivision"
+    __name__ = 'carrier.zone-country.subdivision'
+
+    zone = fields.Many2One(
+        'carrier.zone', 'Zone', required=True, select=True, ondelete='CASCADE'
+    )
+    subdivision = fields.Many2One(
+        'country.subdivision', 'Subdivision', required=True, select=True,
+        ondelete='CASCADE'
+    )
+
+    @classmethod
+    def create(cls, vlist):
+        CarrierZone.clear_zones_cache()
+        return super(CarrierZoneSubdivision, cls).create(vlist)
+
+    @classmethod
+    def delete(cls, records):
+        CarrierZone.clear_zones_cache()
+        super(CarrierZoneSubdivision, cls).delete(records)
+
+
+class CarrierZoneZip(ModelSQL, ModelView):
+    """
+    Carrier Zone Zip
+
+    The zips of a country starting with the prefix, a range of zips like
+    83700 to 83799 is the prefix 837.
+    """
+    __name__ = 'carrier.zone.zip'
+
+    zone = fields.Many2One(
+        'carrier.zone', 'Zone', required=True, select=True, ondelete='CASCADE'
+    )
+    country = fields.Many2One('country.country', 'Country', required=True)
+    prefix = fields.Char('Prefix', required=True)
+
+    @classmethod
+    def create(cls, vlist):
+        CarrierZone.clear_zones_cache()
+        return super(CarrierZoneZip, cls).create(vlist)
+
+    @classmethod
+    def write(cls, *args):
+        CarrierZone.clear_zones_cache()
+        super(CarrierZoneZip, cls).write(*args)
+
+    @classmethod
+    def delete(cls, zips):
+        CarrierZone.clear_zones_cache()
+        super(CarrierZoneZip, cls).delete(zips)